@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2023, CloudBlue
+# All rights reserved.
+#
+
+import asyncio
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Event, Lock
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time. Concurrent callers with the same key wait for
+    the call in flight and share its result or error.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight(object):
+    """
+    SingleFlight for coroutines of the same event loop: concurrent callers with the same key
+    await the call in flight.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(func())
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(call)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class EntitlementCache(object):
+    """
+    Thread safe LRU cache of Google data with an optional time to live in seconds.
+    An instance is meant to live as long as a single report execution.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.version = 0
+        self.single_flight = SingleFlight()
+        self.async_single_flight = AsyncSingleFlight()
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self._is_expired(entry):
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value, calling `loader` to obtain it on a miss. Only one load per
+        key is in flight; concurrent misses wait for it instead of loading again.
+        """
+        value = self.get(key)
+        if value is None:
+            value = self.single_flight.do(key, lambda: self._load(key, loader))
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """
+        get_or_load for a `loader` coroutine function, coalescing the loads of one event loop.
+        """
+        value = self.get(key)
+        if value is None:
+            value = await self.async_single_flight.do(key, lambda: self._load_async(key, loader))
+        return value
+
+    def setdefault(self, key, value, age=0):
+        """
+        Stores the value, obtained `age` seconds ago, unless a fresh one is already cached
+        and returns the cached value.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and not self._is_expired(entry):
+                self._data.move_to_end(key)
+                return entry[1]
+            self._store(key, value, self.clock() - age)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, self.clock())
+
+    def update(self, key, value, change):
+        """
+        Calls change(value) on a value obtained from the cache under its lock, so changes()
+        never copies it halfway changed, and marks it as changed if it is still cached.
+        """
+        with self._lock:
+            change(value)
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is value:
+                self.version += 1
+                self._data[key] = (entry[0], value, self.version)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def changes(self, version=0):
+        """
+        Returns copies of the (key, value) pairs stored or updated after `version` that are not
+        expired, together with the current version.
+        """
+        with self._lock:
+            return [
+                (key, deepcopy(entry[1]))
+                for key, entry in self._data.items()
+                if entry[2] > version and not self._is_expired(entry)
+            ], self.version
+
+    def _load(self, key, loader):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and not self._is_expired(entry):
+                return entry[1]
+        return self.setdefault(key, loader())
+
+    async def _load_async(self, key, loader):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and not self._is_expired(entry):
+                return entry[1]
+        return self.setdefault(key, await loader())
+
+    def _store(self, key, value, stored_at):
+        self.version += 1
+        self._data[key] = (stored_at, value, self.version)
+        self._data.move_to_end(key)
+        self._evict()
+
+    def _is_expired(self, entry):
+        return self.ttl is not None and self.clock() - entry[0] > self.ttl
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+class DiskCache(object):
+    """
+    Persistent key/value store backed by SQLite, shared by report executions running on
+    the same worker. Entries older than `max_age` seconds are considered stale.
+    """
+
+    def __init__(self, path, max_age=900, clock=time.time):
+        self.max_age = max_age
+        self.clock = clock
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, stored_at REAL NOT NULL, value TEXT NOT NULL)',
+            )
+            self._connection.execute(
+                'DELETE FROM entries WHERE stored_at < ?', (self.clock() - self.max_age,),
+            )
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT stored_at, value FROM entries WHERE key = ?', (self._key(key),),
+            ).fetchone()
+        if row is None or self.clock() - row[0] > self.max_age:
+            return None
+        return json.loads(row[1])
+
+    def set(self, key, value):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO entries (key, stored_at, value) VALUES (?, ?, ?)',
+                (self._key(key), self.clock(), json.dumps(value)),
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(list(key))
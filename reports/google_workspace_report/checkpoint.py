@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2023, CloudBlue
+# All rights reserved.
+#
+
+import json
+import sqlite3
+import time
+from threading import Lock
+
+
+class Checkpoint(object):
+    """
+    Progress of a report execution stored in SQLite every `interval` seconds or `rows`
+    subscriptions: the processed subscriptions with their Google data and the cached Google
+    customers. A new execution with the same key resumes from the last saved state, unless
+    the checkpoint was created more than `max_age` seconds ago.
+    """
+
+    def __init__(
+            self,
+            path,
+            key,
+            interval=30,
+            rows=1000,
+            max_age=21600,
+            clock=time.monotonic,
+            wall_clock=time.time,
+    ):
+        self.key = key
+        self.interval = interval
+        self.rows = rows
+        self.max_age = max_age
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self._pending = []
+        self._saved_at = clock()
+        self._cache_version = 0
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints '
+                '(key TEXT PRIMARY KEY, created_at REAL NOT NULL)',
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoint_records '
+                '(key TEXT NOT NULL, id TEXT NOT NULL, value TEXT NOT NULL, '
+                'PRIMARY KEY (key, id))',
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoint_cache '
+                '(key TEXT NOT NULL, cache_key TEXT NOT NULL, stored_at REAL NOT NULL, '
+                'value TEXT NOT NULL, PRIMARY KEY (key, cache_key))',
+            )
+            row = self._connection.execute(
+                'SELECT created_at FROM checkpoints WHERE key = ?', (self.key,),
+            ).fetchone()
+            if row is None or self.wall_clock() - row[0] > self.max_age:
+                # A stale checkpoint is discarded and the execution starts over.
+                self._delete()
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO checkpoints (key, created_at) VALUES (?, ?)',
+                    (self.key, self.wall_clock()),
+                )
+            self.processed = {
+                row[0] for row in self._connection.execute(
+                    'SELECT id FROM checkpoint_records WHERE key = ?', (self.key,),
+                )
+            }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, record_id):
+        if record_id not in self.processed:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM checkpoint_records WHERE key = ? AND id = ?',
+                (self.key, record_id),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def restore(self, cache):
+        """
+        Loads the saved Google customers into the cache, keeping the time they were saved so
+        the cache expires them as if they had been loaded by this execution.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT cache_key, stored_at, value FROM checkpoint_cache WHERE key = ?',
+                (self.key,),
+            ).fetchall()
+        now = self.wall_clock()
+        for cache_key, stored_at, value in rows:
+            cache.setdefault(
+                tuple(json.loads(cache_key)), json.loads(value), age=max(now - stored_at, 0),
+            )
+        self._cache_version = cache.version
+
+    def add(self, record_id, record, cache):
+        """
+        Records a processed subscription, saving the pending ones when a checkpoint is due.
+        """
+        if record_id in self.processed:
+            return
+        self._pending.append((record_id, record))
+        if len(self._pending) >= self.rows or self.clock() - self._saved_at >= self.interval:
+            self.save(cache)
+
+    def save(self, cache):
+        """
+        Saves the pending subscriptions and the Google customers cached or changed since the
+        last checkpoint. Customers with errors are left for the resumed execution to fetch.
+        """
+        stored_at = self.wall_clock()
+        changes, cache_version = cache.changes(self._cache_version)
+        cache_entries = [
+            (json.dumps(list(cache_key)), json.dumps(value))
+            for cache_key, value in changes
+            if not _has_error(value)
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO checkpoint_records (key, id, value) VALUES (?, ?, ?)',
+                [
+                    (self.key, record_id, json.dumps(record))
+                    for record_id, record in self._pending
+                ],
+            )
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO checkpoint_cache (key, cache_key, stored_at, value) '
+                'VALUES (?, ?, ?, ?)',
+                [(self.key, cache_key, stored_at, value) for cache_key, value in cache_entries],
+            )
+        self.processed.update(record_id for record_id, _ in self._pending)
+        self._cache_version = cache_version
+        self._pending = []
+        self._saved_at = self.clock()
+
+    def clear(self):
+        """
+        Discards the checkpoint once the execution has finished.
+        """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM checkpoints WHERE key = ?', (self.key,))
+            self._delete()
+        self.processed = set()
+        self._cache_version = 0
+        self._pending = []
+
+    def _delete(self):
+        self._connection.execute('DELETE FROM checkpoint_records WHERE key = ?', (self.key,))
+        self._connection.execute('DELETE FROM checkpoint_cache WHERE key = ?', (self.key,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def _has_error(entitlements):
+    return 'error' in entitlements or any(
+        'error' in entitlement for entitlement in entitlements.values()
+        if isinstance(entitlement, dict)
+    )
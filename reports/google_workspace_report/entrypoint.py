@@ -4,33 +4,300 @@
 # All rights reserved.
 #
 
-from connect.client import ClientError, R
-
-from .http import GoogleAPIClient, GoogleAPIClientError, obtain_url_for_service
-from ..utils import convert_to_datetime, get_value, parameter_value
-
-HEADERS = (
-    'Subscription ID', 'Subscription External ID', 'Google Entitlement ID',
-    'Subscription Type', 'Purchase Type', 'Google Domain', 'Google Customer ID', 'Item Name', 'Item MPN',
-    'Google SKU', 'Google Product', 'Google Offer ID', 'Google Offer SKU Display Name',
-    'Item Quantity', 'Google Num Units', 'Google Maximum Units', 'Google Assigned Units',
-    'Google Offer Effective Price', 'Google Offer Price',
-    'Creation date', 'Updated date', 'Google Creation Time', 'Google Commitment Start Date',
-    'Google Commitment End Date', 'Google Renewal Enabled', 'Status', 'Google Entitlement Status',
-    'Google Suspension Reasons', 'Google Purchase Order ID', 'Billing Period',
-    'Anniversary Day', 'Anniversary Month', 'Contract ID', 'Contract Name',
-    'Customer ID', 'Customer Name', 'Customer External ID',
-    'Tier 1 ID', 'Tier 1 Name', 'Tier 1 External ID',
-    'Tier 2 ID', 'Tier 2 Name', 'Tier 2 External ID',
-    'Provider Account ID', 'Provider Account name',
-    'Vendor Account ID', 'Vendor Account Name',
-    'Product ID', 'Product Name', 'Hub ID', 'Hub Name',
-    'Error Details',
+import hashlib
+import json
+import os
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+
+from connect.client import ClientError, ConnectClient, R
+
+from .cache import DiskCache, EntitlementCache
+from .checkpoint import Checkpoint
+from .http import (
+    AdaptiveConcurrencyLimiter,
+    AsyncGoogleAPIClientPool,
+    CircuitBreaker,
+    GoogleAPIClientError,
+    GoogleAPIClientPool,
+    obtain_url_for_service,
+    TokenBucket,
+)
+from .pipeline import (
+    async_ordered_map,
+    merge_parallel,
+    ordered_map,
+    ProgressReporter,
+    sharded_map,
 )
+from .snapshot import Snapshot
+from ..utils import (
+    convert_google_timestamp,
+    convert_to_datetime,
+    get_value,
+    index_parameters,
+    indexed_parameter_value,
+)
+
+# The source tells which Google data a column needs: 'entitlement' columns need the customer
+# entitlements and 'offer' columns also need the entitlement offers.
+Column = namedtuple('Column', ('header', 'key', 'extractor', 'source', 'typed'))
+
+
+def _column(header, extractor, source='connect', typed=None):
+    """
+    `typed` are the (key suffix, extractor) pairs replacing the column in the typed outputs,
+    by default the column itself.
+    """
+    return Column(
+        header, header.replace(' ', '_').lower(), extractor, source, typed or (('', extractor),),
+    )
+
+
+def _units_column(header, name):
+    return _column(
+        header,
+        lambda line: get_google_units(name, line.google),
+        'entitlement',
+        typed=(('', lambda line: to_int(get_google_units(name, line.google))),),
+    )
+
+
+def _price_column(header, field):
+    return _column(
+        header,
+        lambda line: get_price(line.price.get(field)),
+        'offer',
+        typed=(
+            ('_amount', lambda line: get_price_amount(line.price.get(field))),
+            ('_currency', lambda line: get_value(line.price, field, 'currency_code')),
+        ),
+    )
+
+
+def _google_time_column(header, extractor):
+    return _column(
+        header,
+        lambda line: google_time(extractor(line)),
+        'entitlement',
+        typed=(('', lambda line: convert_google_timestamp(extractor(line))),),
+    )
+
+
+def _blank(line):
+    return None
+
+
+class _Line(object):
+    """
+    Parts of a subscription and its Google entitlement read by the column extractors.
+    """
+
+    __slots__ = (
+        'subscription', 'params', 'google', 'offer', 'sku', 'price', 'commitment',
+        'items', 'item', 'tiers', 'connection', 'billing', 'events', 'contract',
+    )
+
+    def __init__(self, subscription, params, google_subscription):
+        self.subscription = subscription
+        self.params = params
+        self.google = google_subscription
+        self.offer = google_subscription.get('entitlement_data', {})
+        self.sku = self.offer.get('sku', {})
+        self.price = (self.offer.get('price_by_resources') or [{}])[0].get('price', {})
+        self.commitment = google_subscription.get('commitment_settings', {})
+        self.items = subscription.get('items', [])
+        self.item = get_item_data(self.items)
+        self.tiers = subscription.get('tiers', '')
+        self.connection = subscription['connection']
+        self.billing = subscription.get('billing', {})
+        self.events = subscription['events']
+        self.contract = subscription.get('contract', {})
+
+
+COLUMNS = (
+    _column('Subscription ID', lambda line: line.subscription.get('id')),
+    _column('Subscription External ID', lambda line: line.subscription.get('external_id', '-')),
+    _column('Google Entitlement ID', lambda line: get_entitlement_id(line.params)),
+    _column('Subscription Type', lambda line: get_value(line.subscription, 'connection', 'type')),
+    _column('Purchase Type', lambda line: indexed_parameter_value('purchase_type', line.params)),
+    _column('Google Domain', lambda line: indexed_parameter_value('domain', line.params)),
+    _column('Google Customer ID', lambda line: indexed_parameter_value('customer_id', line.params)),
+    _column('Item Name', lambda line: line.item[0]),
+    _column('Item MPN', lambda line: line.item[1]),
+    _column('Google SKU', lambda line: line.sku.get('name', '-'), 'offer'),
+    _column('Google Product', lambda line: line.sku.get('product', {}).get('name', '-'), 'offer'),
+    _column('Google Offer ID', lambda line: line.offer.get('name', '-'), 'offer'),
+    _column(
+        'Google Offer SKU Display Name',
+        lambda line: line.sku.get('marketing_info', {}).get('display_name', '-'),
+        'offer',
+    ),
+    _column('Item Quantity', lambda line: next(iter(line.items), {}).get('quantity', '-')),
+    _units_column('Google Num Units', 'num_units'),
+    _units_column('Google Maximum Units', 'max_units'),
+    _units_column('Google Assigned Units', 'assigned_units'),
+    _price_column('Google Offer Effective Price', 'base_price'),
+    _price_column('Google Offer Price', 'effective_price'),
+    _column('Creation date', lambda line: convert_to_datetime(line.events['created']['at'])),
+    _column('Updated date', lambda line: convert_to_datetime(line.events['updated']['at'])),
+    _google_time_column('Google Creation Time', lambda line: line.google.get('create_time', '-')),
+    _google_time_column(
+        'Google Commitment Start Date',
+        lambda line: line.commitment.get('start_time', '-'),
+    ),
+    _google_time_column(
+        'Google Commitment End Date',
+        lambda line: line.commitment.get('end_time', '-'),
+    ),
+    _column(
+        'Google Renewal Enabled',
+        lambda line: get_value(line.commitment, 'renewal_settings', 'enable_renewal'),
+        'entitlement',
+    ),
+    _column('Status', lambda line: line.subscription.get('status')),
+    _column(
+        'Google Entitlement Status',
+        lambda line: get_entitlement_status(line.google.get('provisioning_state')),
+        'entitlement',
+    ),
+    _column(
+        'Google Suspension Reasons',
+        lambda line: get_suspension_reasons(line.google.get('suspension_reasons', [-1])[0]),
+        'entitlement',
+    ),
+    _column(
+        'Google Purchase Order ID',
+        lambda line: line.google.get('purchase_order_id', '-'),
+        'entitlement',
+    ),
+    _column(
+        'Billing Period',
+        lambda line: calculate_period(
+            line.billing['period']['delta'],
+            line.billing['period']['uom'],
+        ) if line.billing else '-',
+    ),
+    _column('Anniversary Day', lambda line: get_value(line.billing, 'anniversary', 'day')),
+    _column('Anniversary Month', lambda line: get_value(line.billing, 'anniversary', 'month')),
+    _column('Contract ID', lambda line: line.contract.get('id', '-')),
+    _column('Contract Name', lambda line: line.contract.get('name', '-')),
+    _column('Customer ID', lambda line: get_value(line.tiers, 'customer', 'id')),
+    _column('Customer Name', lambda line: get_value(line.tiers, 'customer', 'name')),
+    _column('Customer External ID', lambda line: get_value(line.tiers, 'customer', 'external_id')),
+    _column('Tier 1 ID', lambda line: get_value(line.tiers, 'tier1', 'id')),
+    _column('Tier 1 Name', lambda line: get_value(line.tiers, 'tier1', 'name')),
+    _column('Tier 1 External ID', lambda line: get_value(line.tiers, 'tier1', 'external_id')),
+    _column('Tier 2 ID', lambda line: get_value(line.tiers, 'tier2', 'id')),
+    _column('Tier 2 Name', lambda line: get_value(line.tiers, 'tier2', 'name')),
+    _column('Tier 2 External ID', lambda line: get_value(line.tiers, 'tier2', 'external_id')),
+    _column('Provider Account ID', lambda line: get_value(line.connection, 'provider', 'id')),
+    _column('Provider Account name', lambda line: get_value(line.connection, 'provider', 'name')),
+    _column('Vendor Account ID', lambda line: get_value(line.connection, 'vendor', 'id')),
+    _column('Vendor Account Name', lambda line: get_value(line.connection, 'vendor', 'name')),
+    _column('Product ID', lambda line: get_value(line.subscription, 'product', 'id')),
+    _column('Product Name', lambda line: get_value(line.subscription, 'product', 'name')),
+    _column('Hub ID', lambda line: get_value(line.connection, 'hub', 'id')),
+    _column('Hub Name', lambda line: get_value(line.connection, 'hub', 'name')),
+    _column('Error Details', lambda line: line.google.get('error', '-'), 'entitlement'),
+)
+
+HEADERS = tuple(column.header for column in COLUMNS)
+JSON_KEYS = tuple(column.key for column in COLUMNS)
+_EXTRACTORS = tuple(column.extractor for column in COLUMNS)
 
 GOOGLE_PRODUCTS = ['PRD-861-570-450', 'PRD-550-104-278']
 
-subscriptions_dict = {}
+# Rows an Excel worksheet can hold below the header row of the template.
+XLSX_MAX_ROWS = 1048576 - 1
+
+# Subscription fields not used by the report, excluded from the Connect responses.
+SUBSCRIPTION_EXCLUDED_FIELDS = (
+    'configuration',
+    'external_uid',
+    'items.params',
+    'params.description',
+    'params.constraints',
+    'params.value_choices',
+)
+
+# Number of subscriptions requested to Connect per page.
+PAGE_SIZE = int(os.getenv('GOOGLE_REPORT_PAGE_SIZE', '100'))
+
+# Splits the subscriptions query into disjoint partitions paginated in parallel:
+# 'product' (one per Google product), 'marketplace' (one per selected marketplace)
+# or 'none' to paginate a single query.
+PARTITION_BY = os.getenv('GOOGLE_REPORT_PARTITION_BY', 'none')
+
+# Number of subscriptions enriched with Google data in parallel while rows are yielded.
+# A value of 1 disables the thread pool and processes subscriptions sequentially.
+PREFETCH_WORKERS = int(os.getenv('GOOGLE_REPORT_PREFETCH_WORKERS', '8'))
+
+# Maximum number of Google customers kept in memory during a report execution and the
+# optional number of seconds after which their data is fetched again.
+CACHE_SIZE = int(os.getenv('GOOGLE_REPORT_CACHE_SIZE', '10000'))
+CACHE_TTL = float(os.getenv('GOOGLE_REPORT_CACHE_TTL', '0')) or None
+
+# Optional SQLite file where Google responses are shared between report executions and
+# the number of seconds they are considered fresh.
+DISK_CACHE_PATH = os.getenv('GOOGLE_REPORT_DISK_CACHE_PATH')
+DISK_CACHE_MAX_AGE = float(os.getenv('GOOGLE_REPORT_DISK_CACHE_MAX_AGE', '900'))
+
+# Retries of transient Google Management Settings errors and the maximum number of requests
+# per second sent to the service by all the workers (0 means no limit).
+MAX_RETRIES = int(os.getenv('GOOGLE_REPORT_MAX_RETRIES', '3'))
+RATE_LIMIT = float(os.getenv('GOOGLE_REPORT_RATE_LIMIT', '0'))
+
+# Connect and read timeouts in seconds of each request to the service.
+CONNECT_TIMEOUT = float(os.getenv('GOOGLE_REPORT_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('GOOGLE_REPORT_READ_TIMEOUT', '30'))
+
+# Consecutive failures after which the remaining requests fail fast, and the seconds to
+# wait before probing the service again.
+BREAKER_THRESHOLD = int(os.getenv('GOOGLE_REPORT_BREAKER_THRESHOLD', '10'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('GOOGLE_REPORT_BREAKER_RESET_TIMEOUT', '60'))
+
+# Converts the Google creation and commitment timestamps to dates like the Connect ones
+# instead of passing the raw strings through.
+NORMALIZE_GOOGLE_DATES = os.getenv('GOOGLE_REPORT_NORMALIZE_GOOGLE_DATES', '') == 'true'
+
+# The progress is reported every PROGRESS_INTERVAL seconds or PROGRESS_ROWS rows,
+# whatever happens first.
+PROGRESS_INTERVAL = float(os.getenv('GOOGLE_REPORT_PROGRESS_INTERVAL', '5'))
+PROGRESS_ROWS = int(os.getenv('GOOGLE_REPORT_PROGRESS_ROWS', '1000'))
+
+# Optional SQLite file keeping the subscriptions of the last execution with the same
+# parameters. Following executions only read and enrich the subscriptions updated since
+# and the ones whose Google data failed.
+SNAPSHOT_PATH = os.getenv('GOOGLE_REPORT_SNAPSHOT_PATH')
+
+# Optional SQLite file where the progress is saved every CHECKPOINT_INTERVAL seconds or
+# CHECKPOINT_ROWS subscriptions, so an interrupted execution is resumed by the next one
+# with the same parameters instead of starting from zero. Checkpoints created more than
+# CHECKPOINT_MAX_AGE seconds ago are discarded.
+CHECKPOINT_PATH = os.getenv('GOOGLE_REPORT_CHECKPOINT_PATH')
+CHECKPOINT_INTERVAL = float(os.getenv('GOOGLE_REPORT_CHECKPOINT_INTERVAL', '30'))
+CHECKPOINT_ROWS = int(os.getenv('GOOGLE_REPORT_CHECKPOINT_ROWS', '1000'))
+CHECKPOINT_MAX_AGE = float(os.getenv('GOOGLE_REPORT_CHECKPOINT_MAX_AGE', '21600'))
+
+# Number of processes the subscriptions are split into by Google customer, each one with
+# its own Google clients and cache. Incremental and checkpointed executions run in a
+# single process.
+SHARDS = int(os.getenv('GOOGLE_REPORT_SHARDS', '1'))
+
+# Number of subscriptions enriched at the same time by an asyncio event loop instead of the
+# PREFETCH_WORKERS threads, 0 keeps the threads. Checkpointed executions use the threads.
+ASYNC_CONCURRENCY = int(os.getenv('GOOGLE_REPORT_ASYNC_CONCURRENCY', '0'))
+
+# Adapts the Google requests in flight, up to the number of workers, to the throttling and
+# errors of the service while keeping the 90th percentile latency under LATENCY_TARGET
+# seconds. The changes of the limit are logged and its final metrics are given to the
+# renderers as the `google_concurrency` extra context.
+ADAPTIVE_CONCURRENCY = os.getenv('GOOGLE_REPORT_ADAPTIVE_CONCURRENCY', '') == 'true'
+LATENCY_TARGET = float(os.getenv('GOOGLE_REPORT_LATENCY_TARGET', '2'))
 
 
 def generate(
@@ -40,32 +307,179 @@ def generate(
         renderer_type=None,
         extra_context_callback=None,
 ):
-    subscriptions = _get_subscriptions(client, parameters)
-    url_for_service = obtain_url_for_service(client)
+    snapshot = Snapshot(SNAPSHOT_PATH, _parameters_key(parameters)) if SNAPSHOT_PATH else None
+    updated_after = snapshot.watermark if snapshot else None
+    started_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+    subscriptions = _get_subscriptions(client, parameters, updated_after)
+    # The service discovery overlaps with the first request of the subscriptions.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        url_future = executor.submit(obtain_url_for_service, client)
+        total = subscriptions.count()
+        url_for_service = url_future.result()
     marketplace_id = parameters['mkp']['choices'][0] if parameters.get('mkp').get('choices') else ""
-    google_client = GoogleAPIClient(client, url_for_service, marketplace_id)
-    total = subscriptions.count()
-    progress = 0
+    max_rows = XLSX_MAX_ROWS if renderer_type == 'xlsx' else None
+    if not updated_after:
+        # The subscriptions of an incremental execution are only known once the snapshot
+        # has been updated.
+        _check_row_limit(total, max_rows)
+    columns = _report_columns(parameters, renderer_type)
+    progress = ProgressReporter(
+        progress_callback, total, interval=PROGRESS_INTERVAL, rows=PROGRESS_ROWS,
+    )
     if renderer_type == 'csv':
-        yield HEADERS
-        progress += 1
-        total += 1
-        progress_callback(progress, total)
+        yield tuple(column.header for column in columns)
+        progress.total += 1
+        progress.advance()
+        progress.report()
 
-    for subscription in subscriptions:
-        if renderer_type == 'json':
-            yield {
-                HEADERS[idx].replace(' ', '_').lower(): value
-                for idx, value in enumerate(_process_line(subscription, google_client))
-            }
+    google_clients = _google_client_pool(client, url_for_service, marketplace_id)
+    cache = EntitlementCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+    checkpoint = None
+    if CHECKPOINT_PATH:
+        checkpoint = Checkpoint(
+            CHECKPOINT_PATH,
+            _parameters_key(parameters),
+            interval=CHECKPOINT_INTERVAL,
+            rows=CHECKPOINT_ROWS,
+            max_age=CHECKPOINT_MAX_AGE,
+        )
+        checkpoint.restore(cache)
+    sharded = SHARDS > 1 and not snapshot and not checkpoint
+    with google_clients:
+        partitions = _partition_subscriptions(subscriptions, parameters, PARTITION_BY)
+        json_keys = tuple(column.key for column in columns)
+        subscriptions = merge_parallel(partitions, PAGE_SIZE)
+        if snapshot:
+            lines = _process_lines_incrementally(
+                subscriptions, google_clients, cache, columns,
+                snapshot, started_at, _selected_statuses(parameters), progress, max_rows,
+                checkpoint,
+            )
+        elif sharded:
+            lines = sharded_map(
+                _process_shard,
+                subscriptions,
+                partial(_shard_of, SHARDS),
+                SHARDS,
+                args=(
+                    client.api_key, client.endpoint, url_for_service, marketplace_id,
+                    parameters, renderer_type, SHARDS,
+                ),
+                buffer_size=PAGE_SIZE,
+            )
         else:
-            yield _process_line(subscription, google_client)
+            lines = _process_lines(
+                subscriptions, google_clients, cache, columns, checkpoint=checkpoint,
+            )
+        for line in lines:
+            if renderer_type == 'json':
+                yield dict(zip(json_keys, line))
+            elif renderer_type == 'jinja':
+                yield _json_line(json_keys, line)
+            else:
+                yield line
+            progress.advance()
+
+    progress.report()
+    limiter = google_clients.concurrency_limiter
+    if extra_context_callback and limiter and not sharded:
+        # The shard processes have their own limiters, which log their changes.
+        extra_context_callback({'google_concurrency': limiter.metrics()})
+
+
+def _check_row_limit(total, max_rows):
+    if max_rows is not None and total > max_rows:
+        raise ValueError(
+            f'The report has {total} subscriptions and an Excel sheet can hold {max_rows}. '
+            'Please narrow the filters or export it as CSV or JSON lines.',
+        )
+
+
+def _report_columns(parameters, renderer_type):
+    columns = _select_columns(parameters, pad=renderer_type == 'xlsx')
+    if renderer_type == 'jinja':
+        columns = _typed_columns(columns)
+    return columns
+
+
+def _google_client_pool(client, url_for_service, marketplace_id, shards=1):
+    disk_cache = DiskCache(DISK_CACHE_PATH, max_age=DISK_CACHE_MAX_AGE) if DISK_CACHE_PATH else None
+    rate_limit = RATE_LIMIT / shards
+    concurrency_limiter = None
+    if ADAPTIVE_CONCURRENCY:
+        maximum = max(PREFETCH_WORKERS, ASYNC_CONCURRENCY)
+        concurrency_limiter = AdaptiveConcurrencyLimiter(
+            initial=min(8, maximum), maximum=maximum, latency_target=LATENCY_TARGET,
+        )
+    return GoogleAPIClientPool(
+        client,
+        url_for_service,
+        default_marketplace_id=marketplace_id,
+        pool_size=PREFETCH_WORKERS,
+        disk_cache=disk_cache,
+        max_retries=MAX_RETRIES,
+        rate_limiter=TokenBucket(rate_limit) if rate_limit > 0 else None,
+        circuit_breaker=CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET_TIMEOUT),
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        concurrency_limiter=concurrency_limiter,
+    )
+
+
+def _shard_of(shards, subscription):
+    """
+    Returns the shard of a subscription from a hash of its Google customer, so the same
+    customer is always enriched and cached by the same process.
+    """
+    params = index_parameters(subscription.get('params'))
+    key = indexed_parameter_value('customer_id', params, '') or subscription['id']
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def _process_shard(
+        batches,
+        api_key,
+        endpoint,
+        url_for_service,
+        marketplace_id,
+        parameters,
+        renderer_type,
+        shards,
+):
+    """
+    Yields the lines of the subscription batches sent to a shard process. Each batch is
+    completed before the next one is read, so no line waits for more subscriptions.
+    """
+    client = ConnectClient(api_key, endpoint=endpoint, use_specs=False)
+    columns = _report_columns(parameters, renderer_type)
+    cache = EntitlementCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+    with _google_client_pool(client, url_for_service, marketplace_id, shards) as google_clients:
+        for subscriptions in batches:
+            yield from _process_lines(subscriptions, google_clients, cache, columns)
+
+
+def _json_line(keys, line):
+    return json.dumps(dict(zip(keys, line)), default=_json_default)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
 
-    progress += 1
-    progress_callback(progress, total)
 
+def _parameters_key(parameters):
+    return hashlib.sha256(
+        json.dumps(parameters, sort_keys=True, default=str).encode('utf-8'),
+    ).hexdigest()
 
-def _get_subscriptions(client, parameters):
+
+def _selected_statuses(parameters):
+    if parameters.get('status'):
+        return parameters['status']['choices']
+    return ['active', 'suspended', 'terminated', 'terminating']
+
+
+def _get_subscriptions(client, parameters, updated_after=None):
     query = R()
     query &= R().product.id.oneof(GOOGLE_PRODUCTS)
     if parameters.get('date') and parameters['date']['after'] != '':
@@ -75,12 +489,247 @@ def _get_subscriptions(client, parameters):
         query &= R().marketplace.id.oneof(parameters['mkp']['choices'])
     if parameters.get('connection_type') and parameters['connection_type']['all'] is False:
         query &= R().asset.connection.type.oneof(parameters['connection_type']['choices'])
-    if parameters.get('status'):
-        query &= R().status.oneof(parameters['status']['choices'])
+    if updated_after:
+        # Every status is read so the subscriptions leaving the selected ones are noticed.
+        query &= R().events.updated.at.ge(updated_after)
     else:
-        query &= R().status.oneof(['active', 'suspended', 'terminated', 'terminating'])
+        query &= R().status.oneof(_selected_statuses(parameters))
+
+    return client.ns('subscriptions').assets.filter(query).select(
+        *[f'-{field}' for field in SUBSCRIPTION_EXCLUDED_FIELDS],
+    ).limit(PAGE_SIZE)
+
+
+def _select_columns(parameters, pad=False):
+    """
+    Returns the columns chosen in the `columns` parameter, all of them if none was chosen.
+    With `pad` the unselected columns are kept blank so the lines match the template.
+    """
+    selection = parameters.get('columns') or {}
+    if selection.get('all') or not selection.get('choices'):
+        return COLUMNS
+    keys = set(selection['choices'])
+    if pad:
+        return tuple(
+            column if column.key in keys else column._replace(extractor=_blank, source=None)
+            for column in COLUMNS
+        )
+    return tuple(column for column in COLUMNS if column.key in keys)
+
+
+def _typed_columns(columns):
+    """
+    Expands the columns into their typed variants, where missing values are null instead
+    of '-', e.g. a price becomes an amount and a currency column.
+    """
+    return tuple(
+        column._replace(key=column.key + suffix, extractor=_null_if_missing(extractor))
+        for column in columns
+        for suffix, extractor in column.typed
+    )
 
-    return client.ns('subscriptions').assets.filter(query)
+
+def _null_if_missing(extractor):
+    def extract(line):
+        value = extractor(line)
+        return None if value == '-' else value
+    return extract
+
+
+def _partition_subscriptions(subscriptions, parameters, partition_by):
+    if partition_by == 'product':
+        return [
+            subscriptions.filter(R().product.id.eq(product_id))
+            for product_id in GOOGLE_PRODUCTS
+        ]
+    mkp = parameters.get('mkp')
+    if partition_by == 'marketplace' and mkp and mkp['all'] is False:
+        return [
+            subscriptions.filter(R().marketplace.id.eq(marketplace_id))
+            for marketplace_id in parameters['mkp']['choices']
+        ]
+    return [subscriptions]
+
+
+def _process_lines(
+        subscriptions,
+        google_clients,
+        cache,
+        columns=COLUMNS,
+        workers=None,
+        checkpoint=None,
+):
+    """
+    Yields the report lines in the same order as the subscriptions. Google data is fetched
+    by up to `workers` threads ahead of the line being built in the calling thread, and only
+    if one of the columns needs it.
+    """
+    extractors = tuple(column.extractor for column in columns)
+    enriched = _enrich_subscriptions(
+        subscriptions, google_clients, cache, columns, workers, checkpoint,
+    )
+    for subscription, params, google_subscription in enriched:
+        yield _build_line(subscription, params, google_subscription, extractors)
+
+
+def _process_lines_incrementally(
+        subscriptions,
+        google_clients,
+        cache,
+        columns,
+        snapshot,
+        watermark,
+        statuses,
+        progress,
+        max_rows=None,
+        checkpoint=None,
+):
+    """
+    Stores the given subscriptions in the snapshot, dropping the ones not in `statuses`, and
+    yields the report lines. The first execution yields them while the snapshot is filled,
+    later ones yield every subscription in it ordered by id once the changes are stored.
+    The subscriptions whose Google data failed are enriched again by the next execution.
+    """
+    extractors = tuple(column.extractor for column in columns)
+    with snapshot:
+        first_execution = snapshot.watermark is None
+        if first_execution:
+            snapshot.clear()
+        else:
+            subscriptions = _with_failed_records(subscriptions, snapshot)
+        removed = []
+        enriched = _enrich_subscriptions(
+            _select_statuses(subscriptions, statuses, removed),
+            google_clients,
+            cache,
+            columns,
+            checkpoint=checkpoint,
+        )
+        for subscription, params, google_subscription in enriched:
+            snapshot.put(
+                subscription['id'],
+                [subscription, google_subscription],
+                failed='error' in google_subscription,
+            )
+            if first_execution:
+                yield _build_line(subscription, params, google_subscription, extractors)
+        for subscription_id in removed:
+            snapshot.delete(subscription_id)
+        snapshot.commit(watermark)
+        if first_execution:
+            return
+        total = snapshot.count()
+        _check_row_limit(total, max_rows)
+        progress.total = progress.done + total
+        for subscription, google_subscription in snapshot.records():
+            params = index_parameters(subscription.get('params'))
+            yield _build_line(subscription, params, google_subscription, extractors)
+
+
+def _select_statuses(subscriptions, statuses, removed):
+    """
+    Yields the subscriptions in `statuses`, adding the ids of the other ones to `removed`.
+    """
+    for subscription in subscriptions:
+        if subscription.get('status') in statuses:
+            yield subscription
+        else:
+            removed.append(subscription['id'])
+
+
+def _with_failed_records(subscriptions, snapshot):
+    """
+    Yields the subscriptions followed by the stored ones whose Google data failed.
+    """
+    changed = set()
+    for subscription in subscriptions:
+        changed.add(subscription['id'])
+        yield subscription
+    for subscription, _ in snapshot.failed_records():
+        if subscription['id'] not in changed:
+            yield subscription
+
+
+def _enrich_subscriptions(
+        subscriptions,
+        google_clients,
+        cache,
+        columns,
+        workers=None,
+        checkpoint=None,
+):
+    workers = PREFETCH_WORKERS if workers is None else workers
+    sources = {column.source for column in columns}
+    google_clients = google_clients if sources & {'entitlement', 'offer'} else None
+    if ASYNC_CONCURRENCY > 0 and google_clients is not None and checkpoint is None:
+        return _enrich_subscriptions_async(subscriptions, google_clients, cache, 'offer' in sources)
+    enrich = partial(_enrich_subscription, google_clients, cache, 'offer' in sources)
+    if checkpoint is None:
+        return ordered_map(enrich, subscriptions, workers)
+    enrich = partial(_resume_subscription, checkpoint, enrich)
+    return _checkpointed(ordered_map(enrich, subscriptions, workers), checkpoint, cache)
+
+
+def _enrich_subscriptions_async(subscriptions, google_clients, cache, fetch_offers):
+    async_clients = AsyncGoogleAPIClientPool(
+        google_clients.connect_client,
+        google_clients.api_url,
+        google_clients.default_marketplace_id,
+        **dict(google_clients.kwargs, pool_size=ASYNC_CONCURRENCY),
+    )
+    return async_ordered_map(
+        partial(_enrich_subscription_async, async_clients, cache, fetch_offers),
+        subscriptions,
+        ASYNC_CONCURRENCY,
+        buffer_size=PAGE_SIZE,
+        cleanup=async_clients.aclose,
+    )
+
+
+def _resume_subscription(checkpoint, enrich, subscription):
+    record = checkpoint.get(subscription['id'])
+    if record is None:
+        return enrich(subscription)
+    subscription, google_subscription = record
+    return subscription, index_parameters(subscription.get('params')), google_subscription
+
+
+def _checkpointed(enriched, checkpoint, cache):
+    """
+    Adds the enriched subscriptions to the checkpoint, which is discarded once all of them
+    have been processed.
+    """
+    with checkpoint:
+        try:
+            for subscription, params, google_subscription in enriched:
+                # Failed Google data is requested again by a resumed execution.
+                if 'error' not in google_subscription:
+                    checkpoint.add(
+                        subscription['id'], [subscription, google_subscription], cache,
+                    )
+                yield subscription, params, google_subscription
+        except Exception:
+            checkpoint.save(cache)
+            raise
+        checkpoint.clear()
+
+
+def _enrich_subscription(google_clients, cache, fetch_offers, subscription):
+    params = index_parameters(subscription.get('params'))
+    if google_clients is None:
+        return subscription, params, {}
+    google_subscription = _process_google_subscription(
+        subscription, params, google_clients, cache, fetch_offers,
+    )
+    return subscription, params, google_subscription
+
+
+async def _enrich_subscription_async(google_clients, cache, fetch_offers, subscription):
+    params = index_parameters(subscription.get('params'))
+    google_subscription = await _process_google_subscription_async(
+        subscription, params, google_clients, cache, fetch_offers,
+    )
+    return subscription, params, google_subscription
 
 
 def calculate_period(delta, uom):
@@ -113,150 +762,218 @@ def get_item_data(items):
         return items[0]['display_name'], items[0]['mpn']
 
 
-def _process_google_subscription(subscription, google_client):
-    params = subscription.get('params', [])
-    google_customer_id = parameter_value('customer_id', params, "")
+def _process_google_subscription(subscription, params, google_clients, cache, fetch_offers=True):
+    target = _google_subscription_target(subscription, params, google_clients)
+    if target is None:
+        return _missing_google_parameters()
+    google_client, google_customer_id, entitlement_id = target
+    entitlements = cache.get_or_load(
+        _customer_cache_key(google_client, google_customer_id),
+        partial(_get_google_subscriptions, google_client, google_customer_id, fetch_offers),
+    )
+    if _needs_offer_data(entitlements, entitlement_id, fetch_offers):
+        cache.single_flight.do(
+            (google_client.marketplace_id, google_customer_id, entitlement_id),
+            partial(
+                _fill_subscription_entitlement_offer_data,
+                google_client, cache, entitlements, google_customer_id, entitlement_id,
+            ),
+        )
+    return _google_subscription_data(entitlements, entitlement_id)
+
+
+async def _process_google_subscription_async(
+        subscription,
+        params,
+        google_clients,
+        cache,
+        fetch_offers=True,
+):
+    target = _google_subscription_target(subscription, params, google_clients)
+    if target is None:
+        return _missing_google_parameters()
+    google_client, google_customer_id, entitlement_id = target
+    entitlements = await cache.get_or_load_async(
+        _customer_cache_key(google_client, google_customer_id),
+        partial(_get_google_subscriptions_async, google_client, google_customer_id, fetch_offers),
+    )
+    if _needs_offer_data(entitlements, entitlement_id, fetch_offers):
+        await cache.async_single_flight.do(
+            (google_client.marketplace_id, google_customer_id, entitlement_id),
+            partial(
+                _fill_subscription_entitlement_offer_data_async,
+                google_client, cache, entitlements, google_customer_id, entitlement_id,
+            ),
+        )
+    return _google_subscription_data(entitlements, entitlement_id)
+
+
+def _google_subscription_target(subscription, params, google_clients):
+    """
+    Returns the Google client, customer id and entitlement id of a subscription, or None when
+    its Google parameters are missing.
+    """
+    google_customer_id = indexed_parameter_value('customer_id', params, "")
     entitlement_id = get_entitlement_id(params)
     if not google_customer_id or not entitlement_id:
-        res = {'error': 'Subscription has missing google parameters.'}
-        return res
-    if google_customer_id not in subscriptions_dict.keys():
-        _get_google_subscriptions(google_client, google_customer_id)
-    if subscriptions_dict[google_customer_id].get('error'):
-        return subscriptions_dict[google_customer_id]
-    _fill_subscription_entitlement_offer_data(google_client, google_customer_id, entitlement_id)
-    return subscriptions_dict.get(google_customer_id).get(entitlement_id, {})
+        return None
+    google_client = google_clients.get(get_value(subscription, 'marketplace', 'id'))
+    return google_client, google_customer_id, entitlement_id
+
+
+def _missing_google_parameters():
+    return {'error': 'Subscription has missing google parameters.'}
+
+
+def _customer_cache_key(google_client, google_customer_id):
+    return google_client.marketplace_id, google_customer_id
+
+
+def _needs_offer_data(entitlements, entitlement_id, fetch_offers):
+    return (
+        fetch_offers
+        and not entitlements.get('error')
+        and not _has_offer_data(entitlements.get(entitlement_id, {}))
+    )
+
+
+def _google_subscription_data(entitlements, entitlement_id):
+    if entitlements.get('error'):
+        return entitlements
+    return entitlements.get(entitlement_id, {})
 
 
-def _fill_subscription_entitlement_offer_data(google_client, google_customer_id, entitlement_id):
+def _has_offer_data(entitlement):
+    return 'entitlement_data' in entitlement or 'error' in entitlement
+
+
+def _fill_subscription_entitlement_offer_data(
+        google_client,
+        cache,
+        entitlements,
+        google_customer_id,
+        entitlement_id,
+):
+    if _has_offer_data(entitlements.get(entitlement_id, {})):
+        return
     try:
-        entitlement_offer_data = google_client.get_entitlement_offer(google_customer_id, entitlement_id)
+        offer = google_client.get_entitlement_offer(google_customer_id, entitlement_id)
     except GoogleAPIClientError as err:
-        subscriptions_dict[google_customer_id][entitlement_id] = {'error': str(err)}
+        change = partial(_set_entitlement_error, entitlement_id, str(err))
+    else:
+        change = partial(_set_entitlement_offers, offers={entitlement_id: offer})
+    _update_customer(cache, google_client, google_customer_id, entitlements, change)
+
+
+async def _fill_subscription_entitlement_offer_data_async(
+        google_client,
+        cache,
+        entitlements,
+        google_customer_id,
+        entitlement_id,
+):
+    if _has_offer_data(entitlements.get(entitlement_id, {})):
         return
+    try:
+        offer = await google_client.get_entitlement_offer(google_customer_id, entitlement_id)
+    except GoogleAPIClientError as err:
+        change = partial(_set_entitlement_error, entitlement_id, str(err))
+    else:
+        change = partial(_set_entitlement_offers, offers={entitlement_id: offer})
+    _update_customer(cache, google_client, google_customer_id, entitlements, change)
 
-    subscriptions_dict[google_customer_id][entitlement_id]['entitlement_data'] = entitlement_offer_data
 
+def _update_customer(cache, google_client, google_customer_id, entitlements, change):
+    # The cached customer is changed under the cache lock so a checkpoint never saves it
+    # halfway changed.
+    cache.update(_customer_cache_key(google_client, google_customer_id), entitlements, change)
 
-def _get_google_subscriptions(google_client, google_customer_id):
+
+def _get_google_subscriptions(google_client, google_customer_id, fetch_offers=True):
     try:
         entitlements = google_client.get_customer_entitlements(google_customer_id)
     except GoogleAPIClientError as err:
-        subscriptions_dict[google_customer_id] = {'error': str(err)}
+        return {'error': str(err)}
+    entitlements = _entitlements_as_dict(entitlements)
+    if fetch_offers and google_client.bulk_offers_supported:
+        _fill_customer_entitlement_offers_data(google_client, entitlements, google_customer_id)
+    return entitlements
+
+
+async def _get_google_subscriptions_async(google_client, google_customer_id, fetch_offers=True):
+    try:
+        entitlements = await google_client.get_customer_entitlements(google_customer_id)
+    except GoogleAPIClientError as err:
+        return {'error': str(err)}
+    entitlements = _entitlements_as_dict(entitlements)
+    if fetch_offers and google_client.bulk_offers_supported:
+        await _fill_customer_entitlement_offers_data_async(
+            google_client, entitlements, google_customer_id,
+        )
+    return entitlements
+
+
+def _fill_customer_entitlement_offers_data(google_client, entitlements, google_customer_id):
+    try:
+        offers = google_client.get_entitlement_offers(google_customer_id, list(entitlements))
+    except GoogleAPIClientError:
+        # Offers not obtained here are requested one by one while processing each subscription.
+        return
+    _set_entitlement_offers(entitlements, offers)
+
+
+async def _fill_customer_entitlement_offers_data_async(
+        google_client,
+        entitlements,
+        google_customer_id,
+):
+    try:
+        offers = await google_client.get_entitlement_offers(
+            google_customer_id, list(entitlements),
+        )
+    except GoogleAPIClientError:
         return
-    subscriptions_dict[google_customer_id] = _entitlements_as_dict(entitlements)
+    _set_entitlement_offers(entitlements, offers)
+
+
+def _set_entitlement_offers(entitlements, offers):
+    for entitlement_id, offer in offers.items():
+        if entitlement_id in entitlements:
+            entitlements[entitlement_id]['entitlement_data'] = offer
+
+
+def _set_entitlement_error(entitlement_id, message, entitlements):
+    entitlements[entitlement_id] = {'error': message}
 
 
 def _entitlements_as_dict(entitlements):
     result = {}
     for entitlement in entitlements:
         _id = entitlement['name'].split('/')[-1]
+        entitlement['parameters_by_name'] = index_parameters(
+            entitlement.get('parameters'), key='name',
+        )
         result[_id] = entitlement
     return result
 
 
-def _process_google_data(google_subscription):
-    data = {}
-    entitlement_data = google_subscription.get('entitlement_data', {})
-    sku = entitlement_data.get('sku', {})
-
-    data['sku'] = sku.get('name', '-')
-    data['product'] = sku.get('product', {}).get('name', '-')
-    data['sku_display_name'] = sku.get('marketing_info', {}).get('display_name', '-')
-    data['offer_id'] = entitlement_data.get('name', '-')
-    data['num_units'] = get_google_parameter('num_units', google_subscription.get('parameters', {})).get(
-        'value', {}).get('int64_value', '-')
-    data['max_units'] = get_google_parameter('max_units', google_subscription.get('parameters', {})).get(
-        'value', {}).get('int64_value', '-')
-    data['assigned_units'] = get_google_parameter('assigned_units', google_subscription.get('parameters', {})).get(
-        'value', {}).get('int64_value', '-')
-    data['effective_price'] = get_price(entitlement_data.get(
-        'price_by_resources', [{}])[0].get('price', {}).get('effective_price', {}))
-    data['base_price'] = get_price(entitlement_data.get(
-        'price_by_resources', [{}])[0].get('price', {}).get('base_price', {}))
-    data['created_time'] = google_subscription.get('create_time', '-')
-    data['commitment_start_date'] = google_subscription.get('commitment_settings', {}).get('start_time', '-')
-    data['commitment_end_date'] = google_subscription.get('commitment_settings', {}).get('end_time', '-')
-    data['renewal_status'] = get_value(
-        google_subscription.get('commitment_settings', ''), 'renewal_settings', 'enable_renewal')
-    data['status'] = get_entitlement_status(google_subscription.get('provisioning_state'))
-    data['suspension_reasons'] = get_suspension_reasons(google_subscription.get('suspension_reasons', [-1])[0])
-    data['purchase_order_id'] = google_subscription.get('purchase_order_id', '-')
-    data['error'] = google_subscription.get('error', '-')
-
-    return data
-
-
-def _process_line(subscription, google_client):
-    params = subscription.get('params', [])
-    item_name, item_mpn = get_item_data(subscription.get('items', []))
-    google_subscription = _process_google_subscription(subscription, google_client)
-    google_data = _process_google_data(google_subscription)
+def _build_line(subscription, params, google_subscription, extractors=_EXTRACTORS):
+    line = _Line(subscription, params, google_subscription)
+    return tuple([extractor(line) for extractor in extractors])
 
-    return (
-        subscription.get('id'),
-        subscription.get('external_id', '-'),
-        get_entitlement_id(params),
-        get_value(subscription, 'connection', 'type'),
-        parameter_value('purchase_type', params),
-        parameter_value('domain', params),
-        parameter_value('customer_id', params),
-        item_name,
-        item_mpn,
-        google_data['sku'],
-        google_data['product'],
-        google_data['offer_id'],
-        google_data['sku_display_name'],
-        next(iter(subscription.get('items', [])), {}).get('quantity', '-'),
-        google_data['num_units'],
-        google_data['max_units'],
-        google_data['assigned_units'],
-        google_data['base_price'],
-        google_data['effective_price'],
-        convert_to_datetime(subscription['events']['created']['at']),
-        convert_to_datetime(subscription['events']['updated']['at']),
-        google_data['created_time'],
-        google_data['commitment_start_date'],
-        google_data['commitment_end_date'],
-        google_data['renewal_status'],
-        subscription.get('status'),
-        google_data['status'],
-        google_data['suspension_reasons'],
-        google_data['purchase_order_id'],
-        calculate_period(
-            subscription['billing']['period']['delta'],
-            subscription['billing']['period']['uom'],
-        ) if 'billing' in subscription else '-',
-        subscription.get('billing', {}).get('anniversary', {}).get('day', '-'),
-        subscription.get('billing', {}).get('anniversary', {}).get('month', '-'),
-        subscription['contract']['id'] if 'contract' in subscription else '-',
-        subscription['contract']['name'] if 'contract' in subscription else '-',
-        get_value(subscription.get('tiers', ''), 'customer', 'id'),
-        get_value(subscription.get('tiers', ''), 'customer', 'name'),
-        get_value(subscription.get('tiers', ''), 'customer', 'external_id'),
-        get_value(subscription.get('tiers', ''), 'tier1', 'id'),
-        get_value(subscription.get('tiers', ''), 'tier1', 'name'),
-        get_value(subscription.get('tiers', ''), 'tier1', 'external_id'),
-        get_value(subscription.get('tiers', ''), 'tier2', 'id'),
-        get_value(subscription.get('tiers', ''), 'tier2', 'name'),
-        get_value(subscription.get('tiers', ''), 'tier2', 'external_id'),
-        get_value(subscription['connection'], 'provider', 'id'),
-        get_value(subscription['connection'], 'provider', 'name'),
-        get_value(subscription['connection'], 'vendor', 'id'),
-        get_value(subscription['connection'], 'vendor', 'name'),
-        get_value(subscription, 'product', 'id'),
-        get_value(subscription, 'product', 'name'),
-        get_value(subscription['connection'], 'hub', 'id'),
-        get_value(subscription['connection'], 'hub', 'name'),
-        google_data['error'],
-    )
 
-
-def get_google_parameter(value, params):
+def get_google_units(name, google_subscription):
     try:
-        return list(filter(lambda param: param['name'] == value, params))[0]
-    except (IndexError, KeyError, TypeError):
-        return {}
+        return google_subscription.get('parameters_by_name', {}).get(name, {}).get(
+            'value', {}).get('int64_value', '-')
+    except AttributeError:
+        return '-'
+
+
+def google_time(value):
+    if NORMALIZE_GOOGLE_DATES:
+        return convert_google_timestamp(value)
+    return value
 
 
 def get_entitlement_status(value):
@@ -296,8 +1013,21 @@ def get_price(price_data):
     return "{:0.2f} {}".format(total, currency)
 
 
+def get_price_amount(price_data):
+    if not price_data:
+        return '-'
+    return int(price_data.get('units') or 0) + int(price_data.get('nanos') or 0) / 10 ** 9
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return '-'
+
+
 def get_entitlement_id(params):
-    param_value = parameter_value('entitlement_id', params, "")
+    param_value = indexed_parameter_value('entitlement_id', params, "")
     if not param_value:
         return param_value
     entitlement_id = param_value.strip('["]')
@@ -1,54 +1,694 @@
-import requests
+import asyncio
+import logging
+import math
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
 from functools import reduce
 from operator import getitem
+from threading import Condition, Lock
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 from connect.client import ConnectClient, R
 
 SERVICE_IDS = ["SRVC-9722-3113", "SRVC-5460-5389"]
 
+# Status codes meaning that the service does not provide the bulk entitlement offer endpoint.
+BULK_NOT_SUPPORTED_STATUSES = (404, 405, 501)
+
+# Status codes of transient errors that are retried with exponential backoff.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Seconds during which the discovered service URL is reused by the report executions of
+# the same process.
+SERVICE_URL_TTL = 300
+
+logger = logging.getLogger(__name__)
+
+_service_urls = {}
+_service_urls_lock = Lock()
+
+
+class TokenBucket(object):
+    """
+    Client side rate limiter allowing `rate` requests per second with bursts of up to
+    `capacity` requests. A single instance is shared by all the workers of a report.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._blocked_until = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            self.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def try_acquire(self):
+        """
+        Takes a token if there is one and returns 0, otherwise the seconds to wait for it.
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = self._blocked_until - now
+            if wait > 0:
+                return wait
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def block(self, seconds):
+        """
+        Holds every request for the given number of seconds, e.g. after a Retry-After header.
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self.clock() + seconds)
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast with the last error once the service has failed `failure_threshold` times in
+    a row. After `reset_timeout` seconds a single request is let through to probe it again.
+    """
+
+    def __init__(self, failure_threshold=10, reset_timeout=60, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self._last_error = None
+        self._opened_at = None
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if not self._probing and self.clock() - self._opened_at >= self.reset_timeout:
+                self._probing = True
+                return
+            raise GoogleAPIClientError(
+                str(self._last_error), status_code=self._last_error.status_code,
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self._last_error = error
+            if self._probing or self.failures >= self.failure_threshold:
+                self._opened_at = self.clock()
+                self._probing = False
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    Limits the requests in flight with additive increase and multiplicative decrease. Every
+    `window` completed requests the limit grows by one, unless the `percentile` of their
+    latencies exceeds `latency_target` seconds or the rate of throttled, failed or 5xx
+    requests reaches `error_rate`, which multiplies it by `decrease_factor`. Every change of
+    the limit is logged.
+    """
+
+    def __init__(
+            self,
+            initial=8,
+            minimum=1,
+            maximum=64,
+            window=20,
+            latency_target=2.0,
+            percentile=0.9,
+            error_rate=0.05,
+            decrease_factor=0.5,
+    ):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.latency_target = latency_target
+        self.percentile = percentile
+        self.error_rate = error_rate
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self.last_latency = None
+        self.last_error_rate = None
+        self._latencies = []
+        self._errors = 0
+        self._async_waiters = deque()
+        self._condition = Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        """
+        Waits for a slot without blocking the event loop. The released slots are handed to
+        the waiting coroutines in order, waking them up from the releasing thread.
+        """
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            if self.in_flight < self.limit and not self._async_waiters:
+                self.in_flight += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._async_waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._condition:
+                if waiter in self._async_waiters:
+                    self._async_waiters.remove(waiter)
+                else:
+                    # The slot was handed over right before the cancellation.
+                    self.in_flight -= 1
+                    self._wake_async_waiters()
+            raise
+
+    def try_acquire(self):
+        with self._condition:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def metrics(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'latency': self.last_latency,
+                'error_rate': self.last_error_rate,
+                'increases': self.increases,
+                'decreases': self.decreases,
+            }
 
-class GoogleAPIClient(object):
-    def __init__(self, connect_client: ConnectClient, api_url, marketplace_id):
+    def release(self, latency, status_code=None):
+        """
+        Frees the slot of a request that took `latency` seconds. A missing status code means
+        that no response was received.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._latencies.append(latency)
+            if status_code is None or status_code == 429 or status_code >= 500:
+                self._errors += 1
+            if len(self._latencies) >= self.window:
+                self._adjust()
+            self._wake_async_waiters()
+            self._condition.notify_all()
+
+    def _wake_async_waiters(self):
+        while self._async_waiters and self.in_flight < self.limit:
+            loop, future = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # The event loop of the waiter is closed.
+                continue
+            self.in_flight += 1
+
+    def _adjust(self):
+        latencies = sorted(self._latencies)
+        self.last_latency = latencies[math.ceil(self.percentile * len(latencies)) - 1]
+        self.last_error_rate = self._errors / len(latencies)
+        limit = self.limit
+        if self.last_error_rate >= self.error_rate or self.last_latency > self.latency_target:
+            self.limit = max(self.minimum, int(self.limit * self.decrease_factor))
+            self.decreases += 1
+        elif self.limit < self.maximum:
+            self.limit += 1
+            self.increases += 1
+        self._latencies = []
+        self._errors = 0
+        if self.limit != limit:
+            logger.info(
+                'Google concurrency limit changed from %d to %d '
+                '(latency %.3fs, error rate %.2f, %d in flight).',
+                limit, self.limit, self.last_latency, self.last_error_rate, self.in_flight,
+            )
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _GoogleAPIClientBase(object):
+    """
+    Request building, caching, retry and circuit breaking shared by the Google Management
+    Settings clients. Subclasses create the session and send the requests.
+    """
+
+    def __init__(
+            self,
+            connect_client: ConnectClient,
+            api_url,
+            marketplace_id,
+            pool_size=10,
+            disk_cache=None,
+            max_retries=3,
+            backoff_factor=0.5,
+            max_backoff=30,
+            rate_limiter=None,
+            circuit_breaker=None,
+            timeout=(5, 30),
+            concurrency_limiter=None,
+    ):
         self.api_url = api_url
         self.client = connect_client
         self.marketplace_id = marketplace_id.upper()
-
-    def get_customer_entitlements(self, customer_id):
-        headers = {
+        self.disk_cache = disk_cache
+        self.bulk_offers_supported = True
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.timeout = timeout
+        self.concurrency_limiter = concurrency_limiter
+        self.headers = {
             "Accept": "application/json",
             "Authorization": self.client.api_key,
         }
-        response = requests.get(
+        self.session = self._create_session(pool_size)
+
+    def _create_session(self, pool_size):
+        raise NotImplementedError
+
+    def _entitlements_request(self, customer_id):
+        return (
+            ('entitlements', self.marketplace_id, customer_id),
             '{}/api/customer_entitlements?marketplace_id={}&customer_id={}'.format(
                 self.api_url,
                 self.marketplace_id,
-                customer_id
-            ), headers=headers
+                customer_id,
+            ),
         )
-        if response.status_code == 200:
-            entitlements = response.json()
-            return entitlements
-        raise GoogleAPIClientError(f'Google Management Settings Error: {response.content}')
 
-    def get_entitlement_offer(self, customer_id, entitlement_id):
-        headers = {
-            "Accept": "application/json",
-            "Authorization": self.client.api_key,
-        }
-        response = requests.get(
+    def _offer_request(self, customer_id, entitlement_id):
+        return (
+            ('entitlement_offer', customer_id, entitlement_id),
             '{}/api/entitlement_offer?marketplace_id={}&customer_id={}&entitlement_id={}'.format(
                 self.api_url,
                 self.marketplace_id,
                 customer_id,
-                entitlement_id
-            ), headers=headers
+                entitlement_id,
+            ),
+        )
+
+    def _offers_url(self, customer_id, entitlement_ids):
+        return (
+            '{}/api/entitlement_offers?marketplace_id={}&customer_id={}'
+            '&entitlement_ids={}'.format(
+                self.api_url,
+                self.marketplace_id,
+                customer_id,
+                ','.join(entitlement_ids),
+            )
+        )
+
+    def _cached_offers(self, customer_id, entitlement_ids):
+        offers = {}
+        missing = []
+        for entitlement_id in entitlement_ids:
+            offer = self._from_disk_cache(('entitlement_offer', customer_id, entitlement_id))
+            if offer is None:
+                missing.append(entitlement_id)
+            else:
+                offers[entitlement_id] = offer
+        return offers, missing
+
+    def _bulk_offers_failed(self, err):
+        if err.status_code not in BULK_NOT_SUPPORTED_STATUSES:
+            raise err
+        self.bulk_offers_supported = False
+
+    def _store_offers(self, customer_id, fetched, offers):
+        for entitlement_id, offer in fetched.items():
+            self._to_disk_cache(('entitlement_offer', customer_id, entitlement_id), offer)
+            offers[entitlement_id] = offer
+        return offers
+
+    def _from_disk_cache(self, cache_key):
+        if self.disk_cache:
+            return self.disk_cache.get(cache_key)
+
+    def _to_disk_cache(self, cache_key, data):
+        if self.disk_cache:
+            self.disk_cache.set(cache_key, data)
+
+    def _record_failure(self, err):
+        if not self.circuit_breaker:
+            return
+        if err.status_code is None or err.status_code in RETRY_STATUSES:
+            self.circuit_breaker.record_failure(err)
+        else:
+            self.circuit_breaker.record_success()
+
+    def _release(self, started_at, response):
+        if self.concurrency_limiter:
+            self.concurrency_limiter.release(
+                time.monotonic() - started_at,
+                response.status_code if response is not None else None,
+            )
+
+    def _error_delay(self, attempt, err):
+        """
+        Returns the seconds to wait before retrying a request that could not be sent.
+        """
+        if attempt >= self.max_retries:
+            raise GoogleAPIClientError(f'Google Management Settings Error: {err}')
+        return self._backoff(attempt)
+
+    def _response_delay(self, attempt, response):
+        """
+        Returns the seconds to wait before retrying a request answered with an error. A
+        Retry-After longer than `max_backoff` is not waited for, the request fails instead.
+        """
+        if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+            raise GoogleAPIClientError(
+                f'Google Management Settings Error: {response.content}',
+                status_code=response.status_code,
+            )
+        delay = _retry_after(response)
+        if delay is None:
+            delay = self._backoff(attempt)
+        elif delay > self.max_backoff:
+            raise GoogleAPIClientError(
+                f'Google Management Settings Error: retry requested in {delay:.0f} seconds: '
+                f'{response.content}',
+                status_code=response.status_code,
+            )
+        elif self.rate_limiter:
+            self.rate_limiter.block(delay)
+        return delay
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+
+class GoogleAPIClient(_GoogleAPIClientBase):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def get_customer_entitlements(self, customer_id):
+        return self._cached_get(*self._entitlements_request(customer_id))
+
+    def get_entitlement_offer(self, customer_id, entitlement_id):
+        return self._cached_get(*self._offer_request(customer_id, entitlement_id))
+
+    def get_entitlement_offers(self, customer_id, entitlement_ids):
+        """
+        Returns the offers of several entitlements of a customer keyed by entitlement id using
+        a single request. If the service has no bulk endpoint only the cached offers are
+        returned, the callers request the ones they need with get_entitlement_offer.
+        """
+        offers, missing = self._cached_offers(customer_id, entitlement_ids)
+        if missing and self.bulk_offers_supported:
+            try:
+                fetched = self._get(self._offers_url(customer_id, missing))
+            except GoogleAPIClientError as err:
+                self._bulk_offers_failed(err)
+            else:
+                return self._store_offers(customer_id, fetched, offers)
+        return offers
+
+    def _create_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(self.headers)
+        return session
+
+    def _cached_get(self, cache_key, url):
+        data = self._from_disk_cache(cache_key)
+        if data is None:
+            data = self._get(url)
+            self._to_disk_cache(cache_key, data)
+        return data
+
+    def _get(self, url):
+        if self.circuit_breaker:
+            self.circuit_breaker.before_call()
+        try:
+            data = self._request(url)
+        except GoogleAPIClientError as err:
+            self._record_failure(err)
+            raise
+        if self.circuit_breaker:
+            self.circuit_breaker.record_success()
+        return data
+
+    def _send(self, url):
+        if self.concurrency_limiter:
+            self.concurrency_limiter.acquire()
+        started_at = time.monotonic()
+        response = None
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            return response
+        finally:
+            self._release(started_at, response)
+
+    def _request(self, url):
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = self._send(url)
+            except requests.RequestException as err:
+                delay = self._error_delay(attempt, err)
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                delay = self._response_delay(attempt, response)
+            time.sleep(delay)
+            attempt += 1
+
+
+class AsyncGoogleAPIClient(_GoogleAPIClientBase):
+    """
+    asyncio version of GoogleAPIClient backed by httpx, with up to `pool_size` connections.
+    Its coroutines must run in the event loop where the client is first used.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.session.aclose()
+
+    async def get_customer_entitlements(self, customer_id):
+        return await self._cached_get(*self._entitlements_request(customer_id))
+
+    async def get_entitlement_offer(self, customer_id, entitlement_id):
+        return await self._cached_get(*self._offer_request(customer_id, entitlement_id))
+
+    async def get_entitlement_offers(self, customer_id, entitlement_ids):
+        offers, missing = await self._with_disk_cache(
+            self._cached_offers, customer_id, entitlement_ids,
+        )
+        if missing and self.bulk_offers_supported:
+            try:
+                fetched = await self._get(self._offers_url(customer_id, missing))
+            except GoogleAPIClientError as err:
+                self._bulk_offers_failed(err)
+            else:
+                return await self._with_disk_cache(
+                    self._store_offers, customer_id, fetched, offers,
+                )
+        return offers
+
+    def _create_session(self, pool_size):
+        return httpx.AsyncClient(
+            headers=self.headers,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
         )
-        if response.status_code == 200:
-            offer = response.json()
-            return offer
-        raise GoogleAPIClientError(f'Google Management Settings Error: {response.content}')
 
+    async def _cached_get(self, cache_key, url):
+        data = await self._with_disk_cache(self._from_disk_cache, cache_key)
+        if data is None:
+            data = await self._get(url)
+            await self._with_disk_cache(self._to_disk_cache, cache_key, data)
+        return data
 
-def obtain_url_for_service(client):
+    async def _with_disk_cache(self, func, *args):
+        # The disk cache blocks on SQLite, so it is used from the default executor to keep
+        # the event loop running other requests.
+        if not self.disk_cache:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _get(self, url):
+        if self.circuit_breaker:
+            self.circuit_breaker.before_call()
+        try:
+            data = await self._request(url)
+        except GoogleAPIClientError as err:
+            self._record_failure(err)
+            raise
+        if self.circuit_breaker:
+            self.circuit_breaker.record_success()
+        return data
+
+    async def _send(self, url):
+        if self.concurrency_limiter:
+            await self.concurrency_limiter.acquire_async()
+        started_at = time.monotonic()
+        response = None
+        try:
+            response = await self.session.get(url)
+            return response
+        finally:
+            self._release(started_at, response)
+
+    async def _request(self, url):
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async()
+            try:
+                response = await self._send(url)
+            except httpx.HTTPError as err:
+                delay = self._error_delay(attempt, err)
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                delay = self._response_delay(attempt, response)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class GoogleAPIClientPool(object):
+    """
+    GoogleAPIClient instances by marketplace, created on first use with the given keyword
+    arguments. Subscriptions without marketplace use `default_marketplace_id`.
+    """
+
+    client_class = GoogleAPIClient
+
+    def __init__(self, connect_client: ConnectClient, api_url, default_marketplace_id='', **kwargs):
+        self.connect_client = connect_client
+        self.api_url = api_url
+        self.default_marketplace_id = default_marketplace_id
+        self.kwargs = kwargs
+        self._clients = {}
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def concurrency_limiter(self):
+        return self.kwargs.get('concurrency_limiter')
+
+    def get(self, marketplace_id=None):
+        if not marketplace_id or marketplace_id == '-':
+            marketplace_id = self.default_marketplace_id
+        with self._lock:
+            client = self._clients.get(marketplace_id)
+            if client is None:
+                client = self.client_class(
+                    self.connect_client, self.api_url, marketplace_id, **self.kwargs,
+                )
+                self._clients[marketplace_id] = client
+            return client
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+        disk_cache = self.kwargs.get('disk_cache')
+        if disk_cache:
+            disk_cache.close()
+
+
+class AsyncGoogleAPIClientPool(GoogleAPIClientPool):
+    """
+    GoogleAPIClientPool of AsyncGoogleAPIClient instances, closed from their event loop.
+    The disk cache is left open for the pool it was taken from.
+    """
+
+    client_class = AsyncGoogleAPIClient
+
+    async def aclose(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+def obtain_url_for_service(client, ttl=SERVICE_URL_TTL):
+    key = (client.endpoint, client.api_key, tuple(SERVICE_IDS))
+    with _service_urls_lock:
+        cached = _service_urls.get(key)
+    if cached and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    url = _discover_url_for_service(client)
+    with _service_urls_lock:
+        _service_urls[key] = (time.monotonic(), url)
+    return url
+
+
+def clear_service_url_cache():
+    with _service_urls_lock:
+        _service_urls.clear()
+
+
+def _discover_url_for_service(client):
     query = R()
     query &= R().status.eq('installed')
     query &= R().environment.extension.id.oneof(SERVICE_IDS)
@@ -63,7 +703,23 @@ def obtain_url_for_service(client):
 
 
 class GoogleAPIClientError(Exception):
-    pass
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
 
 def _get_value(base, path, default="-"):
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2023, CloudBlue
+# All rights reserved.
+#
+
+import asyncio
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+_END = object()
+_POLL_INTERVAL = 0.1
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class ProgressReporter(object):
+    """
+    Counts the produced rows and reports them to `callback` at most once every `interval`
+    seconds or `rows` rows, so long executions show their progress without a call per row.
+    """
+
+    def __init__(self, callback, total, interval=5, rows=1000, clock=time.monotonic):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.rows = rows
+        self.clock = clock
+        self.done = 0
+        self._reported = 0
+        self._reported_at = clock()
+
+    def advance(self, count=1):
+        self.done += count
+        if (
+            self.done - self._reported >= self.rows
+            or self.clock() - self._reported_at >= self.interval
+        ):
+            self.report()
+
+    def report(self):
+        # The count may grow while the report is running, never report more than the total.
+        self.total = max(self.total, self.done)
+        self.callback(self.done, self.total)
+        self._reported = self.done
+        self._reported_at = self.clock()
+
+
+def merge_parallel(iterables, buffer_size=100):
+    """
+    Yields the items of every iterable as soon as they are available, consuming all of them
+    at the same time by background threads into a buffer of `buffer_size` items per
+    iterable. The items of each iterable keep their order, the iterables are interleaved.
+    """
+    stop = Event()
+    queue = Queue(maxsize=buffer_size * max(len(iterables), 1))
+    for iterable in iterables:
+        Thread(target=_feed, args=(iterable, queue, stop), daemon=True).start()
+    try:
+        for _ in iterables:
+            yield from _drain(queue)
+    finally:
+        stop.set()
+
+
+def ordered_map(func, iterable, workers):
+    """
+    Yields func(item) for every item in order, computing up to `workers` results ahead of
+    the one being yielded. A single worker maps the items in the calling thread.
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in iterable:
+                pending.append(executor.submit(func, item))
+                if len(pending) > workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def async_ordered_map(func, iterable, concurrency, buffer_size=100, cleanup=None):
+    """
+    Yields the results of the coroutine function `func` for every item in order. Up to
+    `concurrency` coroutines run at the same time in an event loop of a background thread,
+    which awaits the optional `cleanup` coroutine function before it finishes.
+    """
+    stop = Event()
+    results = Queue(maxsize=buffer_size)
+    Thread(
+        target=_run_async_map,
+        args=(func, iterable, concurrency, cleanup, results, stop),
+        daemon=True,
+    ).start()
+    try:
+        yield from _drain(results)
+    finally:
+        stop.set()
+
+
+def _run_async_map(func, iterable, concurrency, cleanup, results, stop):
+    try:
+        asyncio.run(_async_map(func, iterable, concurrency, cleanup, results, stop))
+    except Exception as err:
+        _put(results, _Failure(err), stop)
+        return
+    _put(results, _END, stop)
+
+
+async def _async_map(func, iterable, concurrency, cleanup, results, stop):
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    pending = deque()
+    try:
+        while not stop.is_set():
+            # The items and the results cross threads in the default executor so the
+            # event loop keeps running the pending coroutines meanwhile.
+            item = await loop.run_in_executor(None, next, iterator, _END)
+            if item is _END:
+                break
+            pending.append(asyncio.ensure_future(func(item)))
+            if len(pending) >= concurrency:
+                result = await pending.popleft()
+                await loop.run_in_executor(None, _put, results, result, stop)
+        while pending and not stop.is_set():
+            result = await pending.popleft()
+            await loop.run_in_executor(None, _put, results, result, stop)
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if cleanup:
+            await cleanup()
+
+
+def sharded_map(func, iterable, shard_of, shards, args=(), buffer_size=100):
+    """
+    Sends every item to the process number `shard_of(item)` out of `shards` and yields the
+    results in the order of the items. Each process calls `func(batches, *args)` once with
+    the iterable of lists of its items, each one holding the items queued at the time. It
+    must yield one result per item in the same order, the results of a list before it reads
+    the next one: the items of the other shards wait for them.
+    """
+    context = multiprocessing.get_context('spawn')
+    inputs = [context.Queue(buffer_size) for _ in range(shards)]
+    outputs = [context.Queue(buffer_size) for _ in range(shards)]
+    processes = [
+        context.Process(
+            target=_run_shard,
+            args=(func, args, inputs[idx], outputs[idx], buffer_size),
+            daemon=True,
+        )
+        for idx in range(shards)
+    ]
+    for process in processes:
+        process.start()
+    stop = Event()
+    order = Queue(maxsize=buffer_size * shards)
+    Thread(target=_distribute, args=(iterable, shard_of, inputs, order, stop), daemon=True).start()
+    try:
+        for shard in _drain(order):
+            result = _get_result(outputs[shard], processes[shard])
+            if isinstance(result, _Failure):
+                raise result.error
+            yield result
+        for process in processes:
+            process.join()
+    finally:
+        stop.set()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def _run_shard(func, args, inputs, outputs, batch_size):
+    try:
+        for result in func(_queued_batches(inputs, batch_size), *args):
+            outputs.put(result)
+    except Exception as err:
+        outputs.put(_Failure(err))
+
+
+def _queued_batches(queue, batch_size):
+    """
+    Yields lists of up to `batch_size` items until the None sentinel, waiting only for the
+    first item of each list so the items already sent are processed without more input.
+    """
+    while True:
+        batch = [queue.get()]
+        while batch[-1] is not None and len(batch) < batch_size:
+            try:
+                batch.append(queue.get_nowait())
+            except Empty:
+                break
+        if batch[-1] is None:
+            batch.pop()
+            if batch:
+                yield batch
+            return
+        yield batch
+
+
+def _distribute(iterable, shard_of, inputs, order, stop):
+    # The shard of an item is queued once the item has been sent, so the results are only
+    # awaited from the shards that received their items.
+    try:
+        for item in iterable:
+            shard = shard_of(item)
+            if not _put(inputs[shard], item, stop) or not _put(order, shard, stop):
+                return
+    except Exception as err:
+        _put(order, _Failure(err), stop)
+        return
+    for queue in inputs:
+        _put(queue, None, stop)
+    _put(order, _END, stop)
+
+
+def _get_result(queue, process):
+    while process.is_alive():
+        try:
+            return queue.get(timeout=_POLL_INTERVAL)
+        except Empty:
+            continue
+    # The results put right before the process exited are still readable.
+    try:
+        return queue.get(timeout=_POLL_INTERVAL)
+    except Empty:
+        raise RuntimeError(f'The shard process exited with code {process.exitcode}.')
+
+
+def _feed(iterable, queue, stop):
+    try:
+        for item in iterable:
+            if not _put(queue, item, stop):
+                return
+    except Exception as err:
+        _put(queue, _Failure(err), stop)
+        return
+    _put(queue, _END, stop)
+
+
+def _drain(queue):
+    while True:
+        item = queue.get()
+        if item is _END:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except Full:
+            continue
+    return False
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2023, CloudBlue
+# All rights reserved.
+#
+
+import json
+import sqlite3
+from threading import Lock
+
+
+class Snapshot(object):
+    """
+    Subscriptions of the last executions of a report with the same parameters, stored in
+    SQLite together with the watermark from which the next execution reads the changes.
+    """
+
+    def __init__(self, path, key, fetch_size=500):
+        self.key = key
+        self.fetch_size = fetch_size
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots '
+                '(key TEXT PRIMARY KEY, watermark TEXT NOT NULL)',
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS records '
+                '(key TEXT NOT NULL, id TEXT NOT NULL, value TEXT NOT NULL, '
+                'failed INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (key, id))',
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def watermark(self):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT watermark FROM snapshots WHERE key = ?', (self.key,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM records WHERE key = ?', (self.key,),
+            ).fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM records WHERE key = ?', (self.key,))
+
+    def put(self, record_id, record, failed=False):
+        """
+        Stores a record, `failed` when its data must be read again by the next execution.
+        """
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO records (key, id, value, failed) VALUES (?, ?, ?, ?)',
+                (self.key, record_id, json.dumps(record), int(failed)),
+            )
+
+    def delete(self, record_id):
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM records WHERE key = ? AND id = ?', (self.key, record_id),
+            )
+
+    def commit(self, watermark):
+        """
+        Moves the watermark, storing it with the changes made since the last commit in a
+        single transaction. The changes not committed are discarded when the snapshot closes.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO snapshots (key, watermark) VALUES (?, ?)',
+                (self.key, watermark),
+            )
+
+    def failed_records(self):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT value FROM records WHERE key = ? AND failed = 1 ORDER BY id', (self.key,),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def records(self):
+        """
+        Yields the stored records ordered by id, reading `fetch_size` of them at a time.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT value FROM records WHERE key = ? ORDER BY id', (self.key,),
+            )
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row[0])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
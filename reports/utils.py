@@ -5,18 +5,67 @@
 #
 
 from datetime import datetime
+from functools import lru_cache
 
 
+@lru_cache(maxsize=4096)
 def convert_to_datetime(param_value):
     if param_value == "" or param_value == "-":
         return "-"
 
+    # Fast path for the 'YYYY-MM-DDTHH:MM:SS+00:00' form returned by Connect.
+    if len(param_value) == 25 and param_value[10] == 'T' and param_value.endswith('+00:00'):
+        try:
+            return _datetime_from_slices(param_value)
+        except ValueError:
+            pass
+
     return datetime.strptime(
         param_value.replace("T", " ").replace("+00:00", ""),
         "%Y-%m-%d %H:%M:%S",
     )
 
 
+@lru_cache(maxsize=4096)
+def convert_google_timestamp(value):
+    """
+    Converts a Google UTC timestamp like '2024-06-14T10:24:31.213Z' to a naive datetime.
+    Values in any other form are returned unchanged.
+    """
+    if not isinstance(value, str) or len(value) < 20 or value[10] != 'T':
+        return value
+    if value.endswith('Z'):
+        body = value[:-1]
+    elif value.endswith('+00:00'):
+        body = value[:-6]
+    else:
+        return value
+    if body[19:20] == '.':
+        fraction = body[20:]
+        if not fraction.isdigit():
+            return value
+    elif len(body) == 19:
+        fraction = ''
+    else:
+        return value
+    try:
+        result = _datetime_from_slices(body)
+    except ValueError:
+        return value
+    if fraction:
+        result = result.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    return result
+
+
+def _datetime_from_slices(value):
+    if value[4] != '-' or value[7] != '-' or value[13] != ':' or value[16] != ':':
+        raise ValueError(value)
+    return datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+    )
+
+
 def get_basic_value(base, value):
     if base and value in base:
         return base[value]
@@ -35,3 +84,20 @@ def parameter_value(parameter_id, parameter_list, default="-"):
         return parameter['value']
     except IndexError:
         return default
+
+
+def index_parameters(parameter_list, key='id'):
+    """
+    Indexes a list of parameters by the given key, keeping the first parameter of each key.
+    """
+    index = {}
+    for parameter in parameter_list or []:
+        index.setdefault(parameter.get(key), parameter)
+    return index
+
+
+def indexed_parameter_value(parameter_id, parameter_index, default="-"):
+    parameter = parameter_index.get(parameter_id)
+    if parameter is None:
+        return default
+    return parameter.get('value', default)
@@ -7,6 +7,7 @@ import json
 import os
 from collections import namedtuple
 from collections.abc import Iterable
+from threading import Lock
 from types import MethodType
 from urllib.parse import parse_qs
 
@@ -19,10 +20,14 @@ ConnectResponse = namedtuple(
     'ConnectResponse',
     (
         'count', 'query', 'ordering', 'select',
-        'value', 'status', 'exception',
+        'value', 'status', 'exception', 'path',
     ),
 )
 
+# RequestsMock patches the transport globally, so mocked calls made by different threads
+# must not overlap.
+_mock_lock = Lock()
+
 
 def _parse_qs(url):
     if '?' not in url:
@@ -68,6 +73,7 @@ def response_factory():
             value=None,
             status=None,
             exception=None,
+            path=None,
     ):
         return ConnectResponse(
             count=count,
@@ -77,6 +83,7 @@ def response_factory():
             value=value,
             status=status,
             exception=exception,
+            path=path,
         )
 
     return _create_response
@@ -85,10 +92,23 @@ def response_factory():
 @pytest.fixture
 def client_factory():
     def _create_client(connect_responses):
-        response_iterator = iter(connect_responses)
+        pending_responses = list(connect_responses)
+        lock = Lock()
+
+        def _next_response(url):
+            # Responses with a path answer the requests to that path whatever their order,
+            # the rest answer the other requests in order.
+            with lock:
+                for idx, res in enumerate(pending_responses):
+                    if res.path and res.path in url:
+                        return pending_responses.pop(idx)
+                for idx, res in enumerate(pending_responses):
+                    if not res.path:
+                        return pending_responses.pop(idx)
+            raise AssertionError(f'Unexpected request to {url}.')
 
         def _execute_http_call(self, method, url, kwargs):
-            res = next(response_iterator)
+            res = _next_response(url)
 
             query, ordering, select = _parse_qs(url)
             if res.query:
@@ -127,7 +147,7 @@ def client_factory():
                 mock_kwargs['status'] = res.status or 200
                 mock_kwargs['body'] = str(res.value)
 
-            with responses.RequestsMock() as rsps:
+            with _mock_lock, responses.RequestsMock() as rsps:
                 rsps.add(
                     method.upper(),
                     url,
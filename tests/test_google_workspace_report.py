@@ -4,14 +4,52 @@
 # All rights reserved.
 #
 
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from datetime import datetime
+from functools import partial
+from threading import Event, Thread, get_ident
 
-from reports.google_workspace_report.http import GoogleAPIClient, GoogleAPIClientError
+import httpx
+import pytest
+from connect.client import ConnectClient
+
+from reports.google_workspace_report import entrypoint
+from reports.google_workspace_report.cache import DiskCache, EntitlementCache, SingleFlight
+from reports.google_workspace_report.checkpoint import Checkpoint
 from reports.google_workspace_report.entrypoint import (
+    _partition_subscriptions,
+    _process_lines,
     calculate_period,
     generate,
     get_price,
     HEADERS, )
+from reports.google_workspace_report.http import (
+    AdaptiveConcurrencyLimiter,
+    AsyncGoogleAPIClient,
+    CircuitBreaker,
+    clear_service_url_cache,
+    GoogleAPIClient,
+    GoogleAPIClientError,
+    GoogleAPIClientPool,
+    obtain_url_for_service,
+    TokenBucket,
+)
+from reports.google_workspace_report.pipeline import (
+    async_ordered_map,
+    merge_parallel,
+    ProgressReporter,
+)
+from reports.google_workspace_report.snapshot import Snapshot
+from reports.utils import (
+    convert_google_timestamp,
+    convert_to_datetime,
+    index_parameters,
+    indexed_parameter_value,
+)
 
 PARAMETERS = {
     'date': None,
@@ -32,7 +70,8 @@ def test_generate(monkeypatch, progress, client_factory, response_factory, insta
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -53,12 +92,18 @@ def test_generate(monkeypatch, progress, client_factory, response_factory, insta
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, PARAMETERS, progress))
 
@@ -71,7 +116,8 @@ def test_generate_without_items(monkeypatch, progress, client_factory, response_
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -93,12 +139,18 @@ def test_generate_without_items(monkeypatch, progress, client_factory, response_
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
 
@@ -112,7 +164,8 @@ def test_generate_drive_items(monkeypatch, progress, client_factory, response_fa
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -135,12 +188,18 @@ def test_generate_drive_items(monkeypatch, progress, client_factory, response_fa
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
 
@@ -155,7 +214,8 @@ def test_generate_several_items(monkeypatch, progress, client_factory, response_
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -177,12 +237,18 @@ def test_generate_several_items(monkeypatch, progress, client_factory, response_
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
 
@@ -198,7 +264,8 @@ def test_generate_no_google_parameters_in_request(monkeypatch, progress, client_
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -222,12 +289,18 @@ def test_generate_no_google_parameters_in_request(monkeypatch, progress, client_
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
 
@@ -243,7 +316,8 @@ def test_generate_google_api_error(monkeypatch, progress, client_factory, respon
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -273,6 +347,9 @@ def test_generate_google_api_error(monkeypatch, progress, client_factory, respon
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offer)
+
     result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
 
     assert len(result) == 1
@@ -304,7 +381,8 @@ def test_generate_all_params(monkeypatch, progress, client_factory, response_fac
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -326,12 +404,18 @@ def test_generate_all_params(monkeypatch, progress, client_factory, response_fac
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, parameters, progress))
 
@@ -351,7 +435,8 @@ def test_generate_csv_renderer(monkeypatch, progress, client_factory, response_f
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -372,12 +457,18 @@ def test_generate_csv_renderer(monkeypatch, progress, client_factory, response_f
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, PARAMETERS, progress, renderer_type='csv'))
 
@@ -395,7 +486,8 @@ def test_generate_json_renderer(monkeypatch, progress, client_factory, response_
     responses.append(
         response_factory(
             query=None,
-            value=installation_list
+            value=installation_list,
+            path='devops/installations',
         ),
     )
     responses.append(
@@ -438,12 +530,18 @@ def test_generate_json_renderer(monkeypatch, progress, client_factory, response_
     def mock_get_entitlement_offer(*args, **kwargs):
         return entitlement_offer_request
 
+    def mock_get_entitlement_offers(self, customer_id, entitlement_ids):
+        return {entitlement_id: entitlement_offer_request for entitlement_id in entitlement_ids}
+
     monkeypatch.setattr(
         GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements)
 
     monkeypatch.setattr(
         GoogleAPIClient, 'get_entitlement_offer', mock_get_entitlement_offer)
 
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', mock_get_entitlement_offers)
+
     client = client_factory(responses)
     result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
 
@@ -464,3 +562,1279 @@ def test_get_price():
     actual = get_price(price)
 
     assert actual == expected
+
+
+def test_process_lines_keeps_order(monkeypatch):
+    def mock_google_subscription(subscription, *_):
+        time.sleep(subscription['delay'])
+        return subscription['id']
+
+    monkeypatch.setattr(entrypoint, '_process_google_subscription', mock_google_subscription)
+    monkeypatch.setattr(
+        entrypoint, '_build_line', lambda subscription, params, google, *_: (google,),
+    )
+    subscriptions = [{'id': f'AS-{idx}', 'delay': (10 - idx) / 1000} for idx in range(10)]
+
+    result = list(_process_lines(subscriptions, object(), None, workers=4))
+
+    assert result == [(f'AS-{idx}',) for idx in range(10)]
+
+
+def test_process_lines_sequential(monkeypatch):
+    monkeypatch.setattr(entrypoint, '_process_google_subscription', lambda sub, *_: sub['id'])
+    monkeypatch.setattr(entrypoint, '_build_line', lambda subscription, *_: (subscription['id'],))
+    subscriptions = [{'id': 'AS-1'}, {'id': 'AS-2'}]
+
+    assert list(_process_lines(subscriptions, None, None, workers=1)) == [('AS-1',), ('AS-2',)]
+
+
+def test_google_api_client_reuses_session(response, entitlements_request,
+                                          entitlement_offer_request):
+    response.add(
+        'GET',
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1',
+        json=entitlements_request,
+    )
+    response.add(
+        'GET',
+        'https://service.example.com/api/entitlement_offer?marketplace_id=MP-123'
+        '&customer_id=C1&entitlement_id=E1',
+        json=entitlement_offer_request,
+    )
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+
+    with GoogleAPIClient(connect_client, 'https://service.example.com', 'mp-123') as google_client:
+        session = google_client.session
+        assert google_client.get_customer_entitlements('C1') == entitlements_request
+        assert google_client.get_entitlement_offer('C1', 'E1') == entitlement_offer_request
+
+    assert google_client.session is session
+    assert response.calls[0].request.headers['Authorization'] == 'ApiKey SU-000:xxx'
+
+
+def test_google_api_client_error(response):
+    response.add(
+        'GET',
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1',
+        status=404,
+        body='Not found',
+    )
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+    google_client = GoogleAPIClient(connect_client, 'https://service.example.com', 'MP-123')
+
+    with pytest.raises(GoogleAPIClientError):
+        google_client.get_customer_entitlements('C1')
+
+
+def test_entitlement_cache_lru_eviction():
+    cache = EntitlementCache(maxsize=2)
+    cache.set('C1', {'E1': {}})
+    cache.set('C2', {'E2': {}})
+    assert cache.get('C1') == {'E1': {}}
+    cache.set('C3', {'E3': {}})
+
+    assert cache.get('C2') is None
+    assert cache.get('C3') == {'E3': {}}
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 1, 1)
+
+
+def test_entitlement_cache_ttl():
+    now = [0]
+    cache = EntitlementCache(ttl=10, clock=lambda: now[0])
+    cache.set('C1', {'E1': {}})
+    assert cache.setdefault('C1', {'E2': {}}) == {'E1': {}}
+
+    now[0] = 11
+
+    assert cache.get('C1') is None
+    assert cache.setdefault('C1', {'E2': {}}) == {'E2': {}}
+
+
+def test_disk_cache_freshness(tmp_path):
+    now = [1000]
+    cache = DiskCache(str(tmp_path / 'cache.db'), max_age=60, clock=lambda: now[0])
+    cache.set(('entitlements', 'MP-123', 'C1'), [{'name': 'E1'}])
+
+    assert cache.get(('entitlements', 'MP-123', 'C1')) == [{'name': 'E1'}]
+    assert cache.get(('entitlements', 'MP-456', 'C1')) is None
+
+    now[0] = 1061
+
+    assert cache.get(('entitlements', 'MP-123', 'C1')) is None
+    cache.close()
+
+
+def test_google_api_client_disk_cache(tmp_path, response, entitlements_request):
+    response.add(
+        'GET',
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1',
+        json=entitlements_request,
+    )
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+    path = str(tmp_path / 'cache.db')
+
+    for _ in range(2):
+        disk_cache = DiskCache(path)
+        with GoogleAPIClient(
+            connect_client, 'https://service.example.com', 'MP-123', disk_cache=disk_cache,
+        ) as gc:
+            assert gc.get_customer_entitlements('C1') == entitlements_request
+        disk_cache.close()
+
+    assert len(response.calls) == 1
+
+
+def test_google_api_client_bulk_offers(response, entitlement_offer_request):
+    response.add(
+        'GET',
+        'https://service.example.com/api/entitlement_offers?marketplace_id=MP-123&customer_id=C1'
+        '&entitlement_ids=E1,E2',
+        json={'E1': entitlement_offer_request, 'E2': entitlement_offer_request},
+    )
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+    google_client = GoogleAPIClient(connect_client, 'https://service.example.com', 'MP-123')
+
+    offers = google_client.get_entitlement_offers('C1', ['E1', 'E2'])
+
+    assert offers == {'E1': entitlement_offer_request, 'E2': entitlement_offer_request}
+    assert len(response.calls) == 1
+
+
+def test_google_api_client_bulk_offers_fallback(response):
+    response.add(
+        'GET',
+        'https://service.example.com/api/entitlement_offers?marketplace_id=MP-123&customer_id=C1'
+        '&entitlement_ids=E1,E2',
+        status=404,
+    )
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+    google_client = GoogleAPIClient(connect_client, 'https://service.example.com', 'MP-123')
+
+    # The offers are left to be requested one by one for the subscriptions that need them.
+    assert google_client.get_entitlement_offers('C1', ['E1', 'E2']) == {}
+    assert google_client.bulk_offers_supported is False
+    assert len(response.calls) == 1
+
+
+def test_google_api_client_retries_transient_errors(monkeypatch, response, entitlements_request):
+    url = (
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1'
+    )
+    response.add('GET', url, status=503)
+    response.add('GET', url, status=429, headers={'Retry-After': '7'})
+    response.add('GET', url, json=entitlements_request)
+    delays = []
+    now = [0]
+
+    def sleep(seconds):
+        delays.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr('reports.google_workspace_report.http.time.sleep', sleep)
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+    rate_limiter = TokenBucket(100, clock=lambda: now[0], sleep=sleep)
+    google_client = GoogleAPIClient(
+        connect_client, 'https://service.example.com', 'MP-123', rate_limiter=rate_limiter,
+    )
+
+    assert google_client.get_customer_entitlements('C1') == entitlements_request
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 0.5
+    assert delays[1] == 7
+
+
+def test_google_api_client_fails_on_long_retry_after(monkeypatch, response):
+    url = (
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1'
+    )
+    response.add('GET', url, status=429, headers={'Retry-After': '3600'})
+    delays = []
+    monkeypatch.setattr('reports.google_workspace_report.http.time.sleep', delays.append)
+    rate_limiter = TokenBucket(100, sleep=delays.append)
+    google_client = GoogleAPIClient(
+        ConnectClient('ApiKey SU-000:xxx', use_specs=False),
+        'https://service.example.com',
+        'MP-123',
+        max_backoff=30,
+        rate_limiter=rate_limiter,
+    )
+
+    with pytest.raises(GoogleAPIClientError) as error:
+        google_client.get_customer_entitlements('C1')
+
+    assert error.value.status_code == 429
+    assert delays == []
+    assert rate_limiter.try_acquire() == 0
+
+
+def test_google_api_client_gives_up_after_retries(monkeypatch, response):
+    url = (
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1'
+    )
+    response.add('GET', url, status=500)
+    monkeypatch.setattr('reports.google_workspace_report.http.time.sleep', lambda delay: None)
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+    google_client = GoogleAPIClient(
+        connect_client, 'https://service.example.com', 'MP-123', max_retries=2,
+    )
+
+    with pytest.raises(GoogleAPIClientError) as err:
+        google_client.get_customer_entitlements('C1')
+
+    assert err.value.status_code == 500
+    assert len(response.calls) == 3
+
+
+def test_token_bucket_waits_for_tokens():
+    now = [0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(2, capacity=2, clock=lambda: now[0], sleep=sleep)
+    for _ in range(3):
+        bucket.acquire()
+    bucket.block(5)
+    bucket.acquire()
+
+    assert waits == [0.5, 5]
+
+
+def test_google_api_client_circuit_breaker(monkeypatch, response, entitlements_request):
+    url = (
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1'
+    )
+    response.add('GET', url, status=502, body='Bad gateway')
+    response.add('GET', url, status=502, body='Bad gateway')
+    response.add('GET', url, json=entitlements_request)
+    now = [0]
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, clock=lambda: now[0])
+    google_client = GoogleAPIClient(
+        connect_client,
+        'https://service.example.com',
+        'MP-123',
+        max_retries=0,
+        circuit_breaker=circuit_breaker,
+    )
+
+    for _ in range(4):
+        with pytest.raises(GoogleAPIClientError) as err:
+            google_client.get_customer_entitlements('C1')
+        assert 'Bad gateway' in str(err.value)
+
+    assert len(response.calls) == 2
+    assert circuit_breaker.is_open
+
+    now[0] = 60
+
+    assert google_client.get_customer_entitlements('C1') == entitlements_request
+    assert not circuit_breaker.is_open
+
+
+def test_generate_excludes_unused_fields(monkeypatch, progress, client_factory, response_factory,
+                                         installation_list, subscription_request,
+                                         entitlements_request, entitlement_offer_request):
+    select = [f'-{field}' for field in entrypoint.SUBSCRIPTION_EXCLUDED_FIELDS]
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1, select=select),
+        response_factory(value=[subscription_request], select=select),
+    ]
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_customer_entitlements', lambda *args: entitlements_request)
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offers', lambda *args: {})
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offer', lambda *args: entitlement_offer_request)
+
+    client = client_factory(responses)
+    result = list(generate(client, PARAMETERS, progress))
+
+    assert len(result) == 1
+
+
+def test_partition_subscriptions_by_product(client_factory):
+    subscriptions = client_factory([]).ns('subscriptions').assets.all()
+
+    partitions = _partition_subscriptions(subscriptions, PARAMETERS, 'product')
+
+    assert [str(partition.query) for partition in partitions] == [
+        f'eq(product.id,{product_id})' for product_id in entrypoint.GOOGLE_PRODUCTS
+    ]
+
+
+def test_partition_subscriptions_by_marketplace(client_factory):
+    subscriptions = client_factory([]).ns('subscriptions').assets.all()
+    parameters = {'mkp': {'all': False, 'choices': ['MP-1', 'MP-2']}}
+
+    partitions = _partition_subscriptions(subscriptions, parameters, 'marketplace')
+
+    assert [str(partition.query) for partition in partitions] == [
+        'eq(marketplace.id,MP-1)', 'eq(marketplace.id,MP-2)',
+    ]
+    assert _partition_subscriptions(subscriptions, PARAMETERS, 'marketplace') == [subscriptions]
+
+
+def test_merge_parallel_keeps_partition_order():
+    def partition(prefix, delay):
+        for idx in range(5):
+            time.sleep(delay)
+            yield f'{prefix}-{idx}'
+
+    result = list(merge_parallel([partition('A', 0.002), partition('B', 0)], buffer_size=2))
+
+    assert sorted(result) == [f'A-{idx}' for idx in range(5)] + [f'B-{idx}' for idx in range(5)]
+    assert [item for item in result if item.startswith('A')] == [f'A-{idx}' for idx in range(5)]
+    assert [item for item in result if item.startswith('B')] == [f'B-{idx}' for idx in range(5)]
+
+
+def test_merge_parallel_overlaps_partitions():
+    resumed = Event()
+
+    def slow_partition():
+        yield 'A-0'
+        # Only resumes once the items of the other partition have been yielded.
+        resumed.wait(5)
+        yield 'A-1'
+
+    result = []
+    for item in merge_parallel([slow_partition(), ['B-0', 'B-1']], buffer_size=1):
+        result.append(item)
+        if item == 'B-1':
+            resumed.set()
+
+    assert result.index('B-1') < result.index('A-1')
+
+
+def test_merge_parallel_raises_partition_errors():
+    def failing_partition():
+        yield 'B-0'
+        raise ValueError('page error')
+
+    with pytest.raises(ValueError):
+        list(merge_parallel([['A-0'], failing_partition()]))
+
+
+def test_merge_parallel_applies_backpressure():
+    consumed = []
+
+    def partition(prefix):
+        for idx in range(10):
+            consumed.append(f'{prefix}-{idx}')
+            yield f'{prefix}-{idx}'
+
+    stream = merge_parallel([partition('A'), partition('B')], buffer_size=2)
+    next(stream)
+    time.sleep(0.05)
+
+    # Two items per partition are buffered, one is yielded and one waits in each thread.
+    assert len(consumed) <= 7
+    assert len(list(stream)) == 19
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.05)
+        return {'E1': {}}
+
+    cache = EntitlementCache()
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda _: cache.get_or_load('C1', load), range(5)))
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_single_flight_shares_errors():
+    single_flight = SingleFlight()
+
+    def fail():
+        time.sleep(0.05)
+        raise GoogleAPIClientError('error message')
+
+    def call(_):
+        try:
+            single_flight.do('C1', fail)
+        except GoogleAPIClientError as err:
+            return str(err)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert list(executor.map(call, range(3))) == ['error message'] * 3
+
+
+def test_generate_routes_subscriptions_by_marketplace(monkeypatch, progress, client_factory,
+                                                      response_factory, installation_list,
+                                                      subscription_request, entitlements_request,
+                                                      entitlement_offer_request):
+    asset1 = deepcopy(subscription_request)
+    asset1['marketplace']['id'] = 'MP-1'
+    asset2 = deepcopy(subscription_request)
+    asset2['id'] = 'AS-123'
+    asset2['marketplace']['id'] = 'MP-2'
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=2),
+        response_factory(value=[asset1, asset2]),
+    ]
+    marketplaces = []
+
+    def mock_get_customer_entitlements(self, customer_id):
+        marketplaces.append(self.marketplace_id)
+        return entitlements_request
+
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_customer_entitlements', mock_get_customer_entitlements,
+    )
+    monkeypatch.setattr(GoogleAPIClient, 'get_entitlement_offers', lambda *args: {})
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offer', lambda *args: entitlement_offer_request,
+    )
+    parameters = deepcopy(PARAMETERS)
+    parameters['mkp'] = {'all': False, 'choices': ['MP-1', 'MP-2']}
+
+    client = client_factory(responses)
+    result = list(generate(client, parameters, progress))
+
+    assert len(result) == 2
+    assert sorted(marketplaces) == ['MP-1', 'MP-2']
+
+
+def test_google_api_client_pool():
+    connect_client = ConnectClient('ApiKey SU-000:xxx', use_specs=False)
+
+    with GoogleAPIClientPool(
+        connect_client, 'https://service.example.com', default_marketplace_id='MP-1',
+    ) as pool:
+        assert pool.get('mp-2').marketplace_id == 'MP-2'
+        assert pool.get('mp-2') is pool.get('mp-2')
+        assert pool.get('-').marketplace_id == 'MP-1'
+        assert pool.get(None) is pool.get('-')
+
+
+def test_obtain_url_for_service_is_cached(client_factory, response_factory, installation_list):
+    clear_service_url_cache()
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+    ])
+
+    url = obtain_url_for_service(client)
+
+    assert url == 'https://srvc-7117-4970-test.ext.conn.rocks'
+    assert obtain_url_for_service(client) == url
+
+
+def test_index_parameters():
+    params = [
+        {'id': 'customer_id', 'value': 'C1'},
+        {'id': 'customer_id', 'value': 'C2'},
+        {'id': 'domain'},
+    ]
+
+    index = index_parameters(params)
+
+    assert indexed_parameter_value('customer_id', index) == 'C1'
+    assert indexed_parameter_value('domain', index) == '-'
+    assert indexed_parameter_value('entitlement_id', index, '') == ''
+
+
+def test_generate_json_values(monkeypatch, progress, client_factory, response_factory,
+                              installation_list, subscription_request, entitlements_request,
+                              entitlement_offer_request):
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1),
+        response_factory(value=[subscription_request]),
+    ]
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_customer_entitlements', lambda *args: entitlements_request,
+    )
+    monkeypatch.setattr(GoogleAPIClient, 'get_entitlement_offers', lambda *args: {})
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offer', lambda *args: entitlement_offer_request,
+    )
+
+    client = client_factory(responses)
+    result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
+
+    assert list(result[0]) == list(entrypoint.JSON_KEYS)
+    assert result[0]['google_entitlement_id'] == 'S1apPpUW7njWBf'
+    assert result[0]['google_customer_id'] == 'SqsV82wiovrjHy'
+    assert result[0]['google_sku'] == 'products/UADAVyrVqM6grP/skus/UVOlkJnG7YE46M'
+    assert result[0]['google_offer_sku_display_name'] == 'Google Workspace Enterprise Plus'
+    assert result[0]['google_maximum_units'] == '1'
+    assert result[0]['google_offer_effective_price'] == '0.00 USD'
+    assert result[0]['google_entitlement_status'] == 'suspended'
+    assert result[0]['google_suspension_reasons'] == 'PENDING_TOS_ACCEPTANCE'
+    assert result[0]['billing_period'] == 'Monthly'
+    assert result[0]['contract_id'] == 'CRD-00000-00000-00000'
+    assert result[0]['hub_name'] == 'ACME Hub'
+    assert result[0]['error_details'] == '-'
+
+
+def test_generate_selected_columns_skip_google(monkeypatch, progress, client_factory,
+                                               response_factory, installation_list,
+                                               subscription_request):
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1),
+        response_factory(value=[subscription_request]),
+    ]
+
+    def fail(*args):
+        raise AssertionError('Google should not be called.')
+
+    monkeypatch.setattr(GoogleAPIClient, 'get_customer_entitlements', fail)
+    monkeypatch.setattr(GoogleAPIClient, 'get_entitlement_offers', fail)
+    monkeypatch.setattr(GoogleAPIClient, 'get_entitlement_offer', fail)
+    parameters = deepcopy(PARAMETERS)
+    parameters['columns'] = {'all': False, 'choices': ['subscription_id', 'google_customer_id']}
+
+    client = client_factory(responses)
+    result = list(generate(client, parameters, progress, renderer_type='csv'))
+
+    assert result == [
+        ('Subscription ID', 'Google Customer ID'),
+        ('AS-2708-7173-4208', 'SqsV82wiovrjHy'),
+    ]
+
+
+def test_generate_selected_columns_skip_offers(monkeypatch, progress, client_factory,
+                                               response_factory, installation_list,
+                                               subscription_request, entitlements_request):
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1),
+        response_factory(value=[subscription_request]),
+    ]
+
+    def fail(*args):
+        raise AssertionError('Offers should not be requested.')
+
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_customer_entitlements', lambda *args: entitlements_request,
+    )
+    monkeypatch.setattr(GoogleAPIClient, 'get_entitlement_offers', fail)
+    monkeypatch.setattr(GoogleAPIClient, 'get_entitlement_offer', fail)
+    parameters = deepcopy(PARAMETERS)
+    parameters['columns'] = {'all': False, 'choices': ['subscription_id', 'google_maximum_units']}
+
+    client = client_factory(responses)
+    result = list(generate(client, parameters, progress, renderer_type='xlsx'))
+
+    assert len(result[0]) == len(HEADERS)
+    assert result[0][0] == 'AS-2708-7173-4208'
+    assert result[0][HEADERS.index('Google Maximum Units')] == '1'
+    assert result[0][HEADERS.index('Subscription External ID')] is None
+
+
+def test_convert_to_datetime():
+    assert convert_to_datetime('2023-02-14T12:22:00+00:00') == datetime(2023, 2, 14, 12, 22)
+    assert convert_to_datetime('2023-02-14 12:22:01') == datetime(2023, 2, 14, 12, 22, 1)
+    assert convert_to_datetime('-') == '-'
+    assert convert_to_datetime('') == '-'
+
+
+def test_convert_google_timestamp():
+    assert convert_google_timestamp('2024-06-14T10:24:31.213Z') == datetime(
+        2024, 6, 14, 10, 24, 31, 213000,
+    )
+    assert convert_google_timestamp('2024-06-14T10:24:31Z') == datetime(2024, 6, 14, 10, 24, 31)
+    assert convert_google_timestamp('2024-06-14T10:24:31.123456789Z') == datetime(
+        2024, 6, 14, 10, 24, 31, 123456,
+    )
+    assert convert_google_timestamp('2024-06-14T10:24:31+02:00') == '2024-06-14T10:24:31+02:00'
+    assert convert_google_timestamp('-') == '-'
+
+
+def test_google_time_normalization(monkeypatch):
+    assert entrypoint.google_time('2024-06-14T10:24:31Z') == '2024-06-14T10:24:31Z'
+
+    monkeypatch.setattr(entrypoint, 'NORMALIZE_GOOGLE_DATES', True)
+
+    assert entrypoint.google_time('2024-06-14T10:24:31Z') == datetime(2024, 6, 14, 10, 24, 31)
+
+
+def test_progress_reporter_throttles_updates():
+    now = [0]
+    calls = []
+    progress = ProgressReporter(
+        lambda *args: calls.append(args), 10, interval=5, rows=3, clock=lambda: now[0],
+    )
+
+    progress.advance()
+    progress.advance()
+    assert calls == []
+
+    progress.advance()
+    assert calls == [(3, 10)]
+
+    now[0] = 6
+    progress.advance()
+    assert calls == [(3, 10), (4, 10)]
+
+    progress.advance(8)
+    progress.report()
+    assert calls[-1] == (12, 12)
+
+
+def test_generate_progress_per_rows(monkeypatch, progress, client_factory, response_factory,
+                                    installation_list, subscription_request):
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=3),
+        response_factory(value=[subscription_request] * 3),
+    ]
+    monkeypatch.setattr(entrypoint, 'PROGRESS_ROWS', 2)
+    parameters = dict(PARAMETERS, columns={'all': False, 'choices': ['subscription_id']})
+
+    client = client_factory(responses)
+    result = list(generate(client, parameters, progress, renderer_type='json'))
+
+    assert len(result) == 3
+    assert [call.args for call in progress.call_args_list] == [(2, 3), (3, 3)]
+
+
+def test_generate_typed_json_lines(monkeypatch, progress, client_factory, response_factory,
+                                   installation_list, subscription_request, entitlements_request,
+                                   entitlement_offer_request):
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1),
+        response_factory(value=[subscription_request]),
+    ]
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_customer_entitlements', lambda *args: entitlements_request,
+    )
+    monkeypatch.setattr(GoogleAPIClient, 'get_entitlement_offers', lambda *args: {})
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_entitlement_offer', lambda *args: entitlement_offer_request,
+    )
+
+    client = client_factory(responses)
+    result = list(generate(client, PARAMETERS, progress, renderer_type='jinja'))
+
+    assert len(result) == 1
+    line = json.loads(result[0])
+    assert line['subscription_id'] == 'AS-2708-7173-4208'
+    assert line['creation_date'] == '2023-02-14T12:22:00'
+    assert line['item_quantity'] == 2
+    assert line['google_maximum_units'] == 1
+    assert line['google_offer_effective_price_amount'] == 0
+    assert line['google_offer_effective_price_currency'] == 'USD'
+    assert line['google_offer_price_amount'] is None
+    assert line['google_creation_time'] == '2024-06-14T10:24:31.213000'
+    assert line['error_details'] is None
+    assert 'google_offer_price' not in line
+    assert progress.call_args.args == (1, 1)
+
+
+def test_generate_xlsx_too_many_rows(monkeypatch, progress, client_factory, response_factory,
+                                     installation_list):
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=entrypoint.XLSX_MAX_ROWS + 1),
+    ]
+
+    client = client_factory(responses)
+    with pytest.raises(ValueError, match='CSV or JSON lines'):
+        list(generate(client, PARAMETERS, progress, renderer_type='xlsx'))
+
+    progress.assert_not_called()
+
+
+def test_generate_incremental(monkeypatch, mocker, tmp_path, progress, client_factory,
+                              response_factory, installation_list, subscription_request):
+    def subscription(subscription_id, status):
+        return dict(deepcopy(subscription_request), id=subscription_id, status=status)
+
+    path = str(tmp_path / 'snapshot.db')
+    monkeypatch.setattr(entrypoint, 'SNAPSHOT_PATH', path)
+    parameters = dict(
+        PARAMETERS,
+        status={'all': False, 'choices': ['active']},
+        columns={'all': False, 'choices': ['subscription_id', 'status']},
+    )
+    key = entrypoint._parameters_key(parameters)
+
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=2),
+        response_factory(value=[subscription('AS-2', 'active'), subscription('AS-1', 'active')]),
+    ])
+    lines = generate(client, parameters, progress)
+
+    # The first execution yields its lines while the snapshot is being filled.
+    assert next(lines) == ('AS-2', 'active')
+    with Snapshot(path, key) as snapshot:
+        assert snapshot.watermark is None
+    assert list(lines) == [('AS-1', 'active')]
+
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=2),
+        response_factory(
+            value=[subscription('AS-2', 'terminated'), subscription('AS-3', 'active')],
+        ),
+    ])
+    get_subscriptions = mocker.spy(entrypoint, '_get_subscriptions')
+    enrich_subscription = mocker.spy(entrypoint, '_enrich_subscription')
+    result = list(generate(client, parameters, progress))
+
+    assert result == [('AS-1', 'active'), ('AS-3', 'active')]
+    updated_after = get_subscriptions.call_args.args[2]
+    assert updated_after is not None
+    assert [call.args[-1]['id'] for call in enrich_subscription.call_args_list] == ['AS-3']
+    assert progress.call_args.args == (2, 2)
+    with Snapshot(path, key) as snapshot:
+        assert snapshot.count() == 2
+        assert snapshot.watermark >= updated_after
+
+    # The changed subscriptions already in the snapshot are not counted twice.
+    monkeypatch.setattr(entrypoint, 'XLSX_MAX_ROWS', 2)
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1),
+        response_factory(value=[subscription('AS-1', 'active')]),
+    ])
+    result = list(generate(client, parameters, progress, renderer_type='xlsx'))
+
+    assert [line[0] for line in result] == ['AS-1', 'AS-3']
+
+
+def test_generate_incremental_retries_google_errors(monkeypatch, tmp_path, progress,
+                                                    client_factory, response_factory,
+                                                    installation_list, subscription_request,
+                                                    entitlements_request):
+    monkeypatch.setattr(entrypoint, 'SNAPSHOT_PATH', str(tmp_path / 'snapshot.db'))
+    parameters = dict(
+        PARAMETERS,
+        status={'all': False, 'choices': ['active']},
+        columns={'all': False, 'choices': ['subscription_id', 'error_details']},
+    )
+
+    def unavailable(*args):
+        raise GoogleAPIClientError('Service unavailable')
+
+    monkeypatch.setattr(GoogleAPIClient, 'get_customer_entitlements', unavailable)
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1),
+        response_factory(value=[dict(subscription_request, status='active')]),
+    ])
+    result = list(generate(client, parameters, progress))
+
+    assert result == [('AS-2708-7173-4208', 'Service unavailable')]
+
+    monkeypatch.setattr(
+        GoogleAPIClient, 'get_customer_entitlements', lambda *args: entitlements_request,
+    )
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=0),
+        response_factory(value=[]),
+    ])
+    result = list(generate(client, parameters, progress))
+
+    assert result == [('AS-2708-7173-4208', '-')]
+
+
+def test_checkpoint_saves_records_and_cache(tmp_path):
+    path = str(tmp_path / 'checkpoint.db')
+    cache = EntitlementCache()
+    cache.set(('MP-1', 'C1'), {'E1': {'name': 'E1'}})
+    with Checkpoint(path, 'key', interval=60, rows=2, clock=lambda: 0) as checkpoint:
+        checkpoint.add('AS-1', [{'id': 'AS-1'}, {}], cache)
+        assert checkpoint.processed == set()
+
+        checkpoint.add('AS-2', [{'id': 'AS-2'}, {}], cache)
+        assert checkpoint.processed == {'AS-1', 'AS-2'}
+
+    restored = EntitlementCache()
+    with Checkpoint(path, 'key') as checkpoint:
+        checkpoint.restore(restored)
+
+        assert checkpoint.get('AS-2') == [{'id': 'AS-2'}, {}]
+        assert checkpoint.get('AS-3') is None
+        assert restored.get(('MP-1', 'C1')) == {'E1': {'name': 'E1'}}
+
+        checkpoint.clear()
+
+    with Checkpoint(path, 'key') as checkpoint:
+        assert checkpoint.processed == set()
+
+
+def test_checkpoint_skips_failed_google_data(tmp_path):
+    path = str(tmp_path / 'checkpoint.db')
+    cache = EntitlementCache()
+    cache.set(('MP-1', 'C1'), {'error': '503 outage'})
+    cache.set(('MP-1', 'C2'), {'E1': {'name': 'E1'}, 'E2': {'error': '503 outage'}})
+    cache.set(('MP-1', 'C3'), {'E1': {'name': 'E1'}})
+
+    def enriched():
+        yield {'id': 'AS-1'}, {}, {'error': '503 outage'}
+        yield {'id': 'AS-2'}, {}, {'name': 'E1'}
+        raise GoogleAPIClientError('Worker restarted')
+
+    with pytest.raises(GoogleAPIClientError):
+        list(entrypoint._checkpointed(enriched(), Checkpoint(path, 'key'), cache))
+
+    restored = EntitlementCache()
+    with Checkpoint(path, 'key') as checkpoint:
+        checkpoint.restore(restored)
+
+        assert checkpoint.processed == {'AS-2'}
+        assert restored.get(('MP-1', 'C1')) is None
+        assert restored.get(('MP-1', 'C2')) is None
+        assert restored.get(('MP-1', 'C3')) == {'E1': {'name': 'E1'}}
+
+
+def test_checkpoint_saves_changed_cache_entries(tmp_path):
+    path = str(tmp_path / 'checkpoint.db')
+    cache = EntitlementCache()
+    entitlements = {'E1': {'name': 'E1'}}
+    cache.set(('MP-1', 'C1'), entitlements)
+    with Checkpoint(path, 'key') as checkpoint:
+        checkpoint.save(cache)
+        # The offer filled after the customer was saved is saved with the next checkpoint.
+        cache.update(
+            ('MP-1', 'C1'),
+            entitlements,
+            partial(entrypoint._set_entitlement_offers, offers={'E1': {'offer': 'O1'}}),
+        )
+        checkpoint.save(cache)
+
+    restored = EntitlementCache()
+    with Checkpoint(path, 'key') as checkpoint:
+        checkpoint.restore(restored)
+
+    assert restored.get(('MP-1', 'C1')) == {
+        'E1': {'name': 'E1', 'entitlement_data': {'offer': 'O1'}},
+    }
+
+
+def test_checkpoint_discards_stale_state(tmp_path):
+    path = str(tmp_path / 'checkpoint.db')
+    now = [1000]
+    cache = EntitlementCache()
+    cache.set(('MP-1', 'C1'), {'E1': {'name': 'E1'}})
+    with Checkpoint(path, 'key', max_age=60, wall_clock=lambda: now[0]) as checkpoint:
+        checkpoint.add('AS-1', [{'id': 'AS-1'}, {}], cache)
+        checkpoint.save(cache)
+
+    # The cached customers keep their age, so they expire with the cache time to live.
+    now[0] = 1030
+    clock = [0]
+    restored = EntitlementCache(ttl=20, clock=lambda: clock[0])
+    with Checkpoint(path, 'key', max_age=60, wall_clock=lambda: now[0]) as checkpoint:
+        checkpoint.restore(restored)
+        assert checkpoint.processed == {'AS-1'}
+    assert restored.get(('MP-1', 'C1')) is None
+
+    now[0] = 1061
+    with Checkpoint(path, 'key', max_age=60, wall_clock=lambda: now[0]) as checkpoint:
+        checkpoint.restore(restored)
+        assert checkpoint.processed == set()
+        assert checkpoint.get('AS-1') is None
+
+
+def test_generate_resumes_from_checkpoint(monkeypatch, tmp_path, progress, client_factory,
+                                          response_factory, installation_list,
+                                          subscription_request):
+    subscriptions = [
+        dict(deepcopy(subscription_request), id=subscription_id)
+        for subscription_id in ('AS-1', 'AS-2', 'AS-3')
+    ]
+    path = str(tmp_path / 'checkpoint.db')
+    monkeypatch.setattr(entrypoint, 'CHECKPOINT_PATH', path)
+    monkeypatch.setattr(entrypoint, 'CHECKPOINT_ROWS', 1)
+    monkeypatch.setattr(entrypoint, 'PREFETCH_WORKERS', 1)
+    parameters = dict(PARAMETERS, columns={'all': False, 'choices': ['subscription_id']})
+    enrich_subscription = entrypoint._enrich_subscription
+    enriched = []
+
+    def failing_enrich_subscription(google_clients, cache, fetch_offers, subscription):
+        if subscription['id'] == 'AS-2':
+            raise GoogleAPIClientError('Worker restarted')
+        return enrich_subscription(google_clients, cache, fetch_offers, subscription)
+
+    monkeypatch.setattr(entrypoint, '_enrich_subscription', failing_enrich_subscription)
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=3),
+        response_factory(value=subscriptions),
+    ])
+    with pytest.raises(GoogleAPIClientError):
+        list(generate(client, parameters, progress))
+
+    def tracking_enrich_subscription(google_clients, cache, fetch_offers, subscription):
+        enriched.append(subscription['id'])
+        return enrich_subscription(google_clients, cache, fetch_offers, subscription)
+
+    monkeypatch.setattr(entrypoint, '_enrich_subscription', tracking_enrich_subscription)
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=3),
+        response_factory(value=subscriptions),
+    ])
+    result = list(generate(client, parameters, progress))
+
+    assert result == [('AS-1',), ('AS-2',), ('AS-3',)]
+    assert enriched == ['AS-2', 'AS-3']
+    with Checkpoint(path, entrypoint._parameters_key(parameters)) as checkpoint:
+        assert checkpoint.processed == set()
+
+
+def test_shard_of_is_stable_by_customer():
+    def subscription(subscription_id, customer_id):
+        return {
+            'id': subscription_id,
+            'params': [{'id': 'customer_id', 'value': customer_id}] if customer_id else [],
+        }
+
+    shards = {entrypoint._shard_of(4, subscription(f'AS-{idx}', 'C1')) for idx in range(10)}
+
+    assert len(shards) == 1
+    assert entrypoint._shard_of(4, subscription('AS-1', 'C1')) == entrypoint._shard_of(
+        4, subscription('AS-1', 'C1'),
+    )
+    assert entrypoint._shard_of(4, subscription('AS-1', None)) in range(4)
+    assert {entrypoint._shard_of(4, subscription('AS-1', f'C{idx}')) for idx in range(20)} == {
+        0, 1, 2, 3,
+    }
+
+
+def test_generate_sharded(monkeypatch, progress, client_factory, response_factory,
+                          installation_list, subscription_request):
+    subscriptions = []
+    for idx in range(6):
+        subscription = deepcopy(subscription_request)
+        subscription['id'] = f'AS-{idx}'
+        for param in subscription['params']:
+            if param['id'] == 'customer_id':
+                param['value'] = f'C{idx}'
+        subscriptions.append(subscription)
+    monkeypatch.setattr(entrypoint, 'SHARDS', 2)
+    parameters = dict(PARAMETERS, columns={'all': False, 'choices': ['subscription_id']})
+
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=6),
+        response_factory(value=subscriptions),
+    ])
+    result = list(generate(client, parameters, progress, renderer_type='json'))
+
+    assert result == [{'subscription_id': f'AS-{idx}'} for idx in range(6)]
+    assert len({entrypoint._shard_of(2, subscription) for subscription in subscriptions}) == 2
+
+
+def test_generate_sharded_skewed_customers(monkeypatch, progress, client_factory,
+                                           response_factory, installation_list,
+                                           subscription_request):
+    subscriptions = [
+        dict(deepcopy(subscription_request), id=f'AS-{idx:02}') for idx in range(30)
+    ]
+    monkeypatch.setattr(entrypoint, 'SHARDS', 2)
+    monkeypatch.setattr(entrypoint, 'PAGE_SIZE', 2)
+    # A single customer gets every subscription but the first one.
+    monkeypatch.setattr(
+        entrypoint, '_shard_of', lambda shards, subscription: int(subscription['id'] != 'AS-00'),
+    )
+    parameters = dict(PARAMETERS, columns={'all': False, 'choices': ['subscription_id']})
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=30),
+        response_factory(value=subscriptions),
+    ])
+    result = []
+    thread = Thread(
+        target=lambda: result.extend(generate(client, parameters, progress)), daemon=True,
+    )
+    thread.start()
+    thread.join(60)
+
+    assert not thread.is_alive()
+    assert result == [(subscription['id'],) for subscription in subscriptions]
+
+
+async def _async_client(handler, marketplace_id='MP-1'):
+    connect_client = ConnectClient('Key', use_specs=False)
+    client = AsyncGoogleAPIClient(connect_client, 'https://google', marketplace_id)
+    await client.session.aclose()
+    client.session = httpx.AsyncClient(
+        headers=client.headers, transport=httpx.MockTransport(handler),
+    )
+    return client
+
+
+def test_async_client_retries(monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) == 1:
+            return httpx.Response(503, content=b'Unavailable')
+        return httpx.Response(200, json=[{'name': 'customers/C1/entitlements/E1'}])
+
+    async def get_entitlements():
+        async with await _async_client(handler, 'mp-1') as client:
+            return await client.get_customer_entitlements('C1')
+
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr('reports.google_workspace_report.http.asyncio.sleep', no_sleep)
+
+    assert asyncio.run(get_entitlements()) == [{'name': 'customers/C1/entitlements/E1'}]
+    assert len(requests) == 2
+    assert requests[1].headers['Authorization'] == 'Key'
+    assert str(requests[1].url) == (
+        'https://google/api/customer_entitlements?marketplace_id=MP-1&customer_id=C1'
+    )
+
+
+def test_async_client_disk_cache_off_event_loop(tmp_path):
+    threads = []
+
+    class RecordingDiskCache(DiskCache):
+        def get(self, key):
+            threads.append(get_ident())
+            return super().get(key)
+
+        def set(self, key, value):
+            threads.append(get_ident())
+            super().set(key, value)
+
+    def handler(request):
+        return httpx.Response(200, json=[{'name': 'customers/C1/entitlements/E1'}])
+
+    async def get_entitlements():
+        async with await _async_client(handler) as client:
+            client.disk_cache = disk_cache
+            await client.get_customer_entitlements('C1')
+            return get_ident()
+
+    disk_cache = RecordingDiskCache(str(tmp_path / 'cache.db'))
+    loop_thread = asyncio.run(get_entitlements())
+    disk_cache.close()
+
+    assert len(threads) == 2
+    assert loop_thread not in threads
+
+
+def test_async_client_gives_up_on_client_errors():
+    def handler(request):
+        return httpx.Response(404, content=b'Not found')
+
+    async def get_offer():
+        async with await _async_client(handler) as client:
+            return await client.get_entitlement_offer('C1', 'E1')
+
+    with pytest.raises(GoogleAPIClientError) as error:
+        asyncio.run(get_offer())
+
+    assert error.value.status_code == 404
+
+
+def test_async_ordered_map_keeps_order_and_concurrency():
+    running = []
+    peak = []
+
+    async def double(item):
+        running.append(item)
+        peak.append(len(running))
+        await asyncio.sleep(0.01 * (5 - item % 5))
+        running.remove(item)
+        return item * 2
+
+    assert list(async_ordered_map(double, range(20), 4)) == [item * 2 for item in range(20)]
+    assert max(peak) == 4
+
+
+def test_async_ordered_map_propagates_errors():
+    async def fail(item):
+        if item == 3:
+            raise ValueError('Boom')
+        return item
+
+    with pytest.raises(ValueError, match='Boom'):
+        list(async_ordered_map(fail, range(10), 2))
+
+
+def test_cache_get_or_load_async_coalesces_loads():
+    cache = EntitlementCache()
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return {'E1': {}}
+
+    async def load_many():
+        return await asyncio.gather(
+            *[cache.get_or_load_async(('MP', 'C1'), loader) for _ in range(5)],
+        )
+
+    assert asyncio.run(load_many()) == [{'E1': {}}] * 5
+    assert len(loads) == 1
+    assert cache.get(('MP', 'C1')) == {'E1': {}}
+
+
+def test_generate_async_enrichment(monkeypatch, progress, client_factory, response_factory,
+                                   installation_list, subscription_request, entitlements_request,
+                                   entitlement_offer_request):
+    async def get_customer_entitlements(*args):
+        return entitlements_request
+
+    async def get_entitlement_offers(*args):
+        return {}
+
+    async def get_entitlement_offer(*args):
+        return entitlement_offer_request
+
+    for name, method in (
+        ('get_customer_entitlements', get_customer_entitlements),
+        ('get_entitlement_offers', get_entitlement_offers),
+        ('get_entitlement_offer', get_entitlement_offer),
+    ):
+        monkeypatch.setattr(AsyncGoogleAPIClient, name, method)
+    monkeypatch.setattr(entrypoint, 'ASYNC_CONCURRENCY', 10)
+    responses = [
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=2),
+        response_factory(value=[subscription_request, dict(subscription_request, id='AS-2')]),
+    ]
+
+    client = client_factory(responses)
+    result = list(generate(client, PARAMETERS, progress, renderer_type='json'))
+
+    assert [line['subscription_id'] for line in result] == ['AS-2708-7173-4208', 'AS-2']
+    assert result[0]['google_entitlement_id'] == 'S1apPpUW7njWBf'
+    assert result[0]['google_offer_sku_display_name'] == 'Google Workspace Enterprise Plus'
+    assert result[1]['google_maximum_units'] == '1'
+    assert result[1]['error_details'] == '-'
+
+
+def test_adaptive_concurrency_limiter_aimd():
+    limiter = AdaptiveConcurrencyLimiter(
+        initial=4, minimum=1, maximum=5, window=4, latency_target=1,
+    )
+
+    def complete(latencies, status_codes):
+        for latency, status_code in zip(latencies, status_codes):
+            limiter.acquire()
+            limiter.release(latency, status_code)
+
+    complete([0.1] * 4, [200] * 4)
+    assert limiter.limit == 5
+
+    complete([0.1] * 4, [200] * 4)
+    assert limiter.limit == 5
+
+    complete([0.1] * 4, [200, 429, 200, 200])
+    assert limiter.limit == 2
+
+    complete([0.1, 0.1, 0.1, 3], [200] * 4)
+    assert limiter.limit == 1
+
+    complete([0.1] * 4, [200, 200, None, 200])
+    assert limiter.metrics() == {
+        'limit': 1,
+        'in_flight': 0,
+        'latency': 0.1,
+        'error_rate': 0.25,
+        'increases': 1,
+        'decreases': 3,
+    }
+
+
+def test_adaptive_concurrency_limiter_blocks_over_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial=1, window=100)
+    limiter.acquire()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(limiter.acquire)
+        time.sleep(0.05)
+        assert not future.done()
+        assert limiter.try_acquire() is False
+
+        limiter.release(0.1, 200)
+        future.result(timeout=1)
+
+    assert limiter.in_flight == 1
+
+
+def test_adaptive_concurrency_limiter_wakes_async_waiters():
+    limiter = AdaptiveConcurrencyLimiter(initial=1, window=100)
+
+    async def wait_for_slots():
+        await limiter.acquire_async()
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        cancelled = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        # The slot is released by another thread, as the requests of a worker do.
+        await asyncio.get_running_loop().run_in_executor(None, limiter.release, 0.1, 200)
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(wait_for_slots())
+
+    assert limiter.in_flight == 1
+    assert not limiter._async_waiters
+
+
+def test_generate_reports_concurrency_metrics(monkeypatch, mocker, progress, client_factory,
+                                              response_factory, installation_list,
+                                              subscription_request):
+    monkeypatch.setattr(entrypoint, 'ADAPTIVE_CONCURRENCY', True)
+    extra_context = mocker.MagicMock()
+    client = client_factory([
+        response_factory(value=installation_list, path='devops/installations'),
+        response_factory(count=1),
+        response_factory(value=[subscription_request]),
+    ])
+    parameters = dict(PARAMETERS, columns={'all': False, 'choices': ['subscription_id']})
+    list(generate(client, parameters, progress, extra_context_callback=extra_context))
+
+    metrics = extra_context.call_args.args[0]['google_concurrency']
+    assert metrics['limit'] == min(8, entrypoint.PREFETCH_WORKERS)
+    assert metrics['in_flight'] == 0
+
+
+def test_google_api_client_reports_to_concurrency_limiter(monkeypatch, response,
+                                                          entitlements_request):
+    url = (
+        'https://service.example.com/api/customer_entitlements?marketplace_id=MP-123'
+        '&customer_id=C1'
+    )
+    response.add('GET', url, status=503)
+    response.add('GET', url, json=entitlements_request)
+    monkeypatch.setattr('reports.google_workspace_report.http.time.sleep', lambda seconds: None)
+    limiter = AdaptiveConcurrencyLimiter(initial=4, window=2)
+    google_client = GoogleAPIClient(
+        ConnectClient('ApiKey SU-000:xxx', use_specs=False),
+        'https://service.example.com',
+        'MP-123',
+        concurrency_limiter=limiter,
+    )
+
+    assert google_client.get_customer_entitlements('C1') == entitlements_request
+    assert limiter.in_flight == 0
+    assert limiter.last_error_rate == 0.5
+    assert limiter.limit == 2